@@ -1,25 +1,87 @@
 # triangle_bybit_protected_bot.py
-import ccxt.async_support as ccxt
 import asyncio
+import bisect
 import os
+import glob
+import gzip
 import hashlib
+import heapq
+import itertools
+import html
+import importlib
+import json
+import multiprocessing
+import queue
+import struct
+import sys
 import time
+import numpy as np
 from datetime import datetime
-from telegram import Bot
-from telegram.constants import ParseMode
-from telegram.ext import Application
+
+class LazyModule:
+    """Модуль, импортируемый при первом обращении к атрибуту"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+    
+    def __getattr__(self, attr):
+        if self.module is None:
+            started = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            STARTUP["phases"][f"import {self.name}"] = time.perf_counter() - started
+        return getattr(self.module, attr)
+
+# ccxt импортирует классы всех бирж (~0.5 с): загружаем его только когда нужен клиент
+ccxt = LazyModule("ccxt.async_support")
+
+# === Запуск ===
+STARTUP = {"started": time.time(), "phases": {}, "first_scan": None}  # Время до первого сканирования от загрузки модуля
 
 # === Конфигурация сети ===
 TESTNET_MODE = os.getenv("TESTNET_MODE", "true").lower() == "true"
 DEBUG_MODE = os.getenv("DEBUG_MODE", "true").lower() == "true"
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_ENABLED = bool(TELEGRAM_TOKEN and TELEGRAM_CHAT_ID)  # Клиент Telegram создается в фоне после старта
+
+# === Очередь уведомлений Telegram ===
+TELEGRAM_QUEUE_SIZE = int(os.getenv("TELEGRAM_QUEUE_SIZE", "500"))  # Максимум отладочных строк в очереди
+TELEGRAM_MIN_INTERVAL = float(os.getenv("TELEGRAM_MIN_INTERVAL", "1.0"))  # Пауза между сообщениями в чат, сек
+TELEGRAM_MAX_LENGTH = 4000  # Лимит Telegram - 4096 символов
+ALERT_QUEUE = asyncio.Queue()  # Торговые уведомления, уходят раньше отладки
+DEBUG_QUEUE = asyncio.Queue(maxsize=TELEGRAM_QUEUE_SIZE)
+DEBUG_HELD = []  # Строка, не поместившаяся в прошлую пачку: уходит первой в следующей
+NOTIFY_EVENT = asyncio.Event()
+NOTIFY_STATS = {"sent": 0, "dropped": 0}
+
+# === Площадки ===
+PRIMARY_VENUE = "bybit"
+EXTRA_VENUES = [v.strip().lower() for v in os.getenv("EXTRA_VENUES", "").split(",") if v.strip()]  # Доп. биржи ccxt для межбиржевого поиска
+VENUE_FEES = {  # Тейкерские комиссии по площадкам: "bybit:0.001,okx:0.001"
+    venue: float(fee) for venue, fee in
+    (item.split(":", 1) for item in os.getenv("VENUE_FEES", "bybit:0.001").split(",") if ":" in item)
+}
+VENUE_API_URLS = {  # Подмена API площадки, например на локальную мок-биржу: "okx:http://127.0.0.1:8081"
+    venue: url for venue, url in
+    (item.split(":", 1) for item in os.getenv("VENUE_API_URLS", "").split(",") if ":" in item)
+}
+CROSS_VENUE_INTERVAL = int(os.getenv("CROSS_VENUE_INTERVAL", "10"))  # Период межбиржевого поиска, сек
+VENUES = {}  # venue id -> клиент, ведра лимитов, кэш стаканов, рынки и комиссия дополнительной площадки
 
 # === Параметры торговли ===
-COMMISSION_RATE = 0.001
+COMMISSION_RATE = VENUE_FEES.get(PRIMARY_VENUE, 0.001)
 MAX_PROFIT = 5.0
-START_COINS = ['USDT']  # Упрощено до USDT для упрощения логики
-LOG_FILE = "trades_log.csv"
+START_COINS = [c.strip() for c in os.getenv("START_COINS", "USDT").split(",") if c.strip()]
+MAX_CYCLE_LENGTH = int(os.getenv("MAX_CYCLE_LENGTH", "3"))  # 3 - треугольники, 4 - также 4-шаговые циклы
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")  # Сегменты журнала сделок
+JOURNAL_FLUSH_SIZE = int(os.getenv("JOURNAL_FLUSH_SIZE", "100"))  # Сброс на диск по числу записей
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "5"))  # ...или по времени, сек
+JOURNAL_ROTATE_BYTES = int(os.getenv("JOURNAL_ROTATE_BYTES", str(16 * 1024 * 1024)))
+JOURNAL_FIELDS = ["timestamp", "network", "route", "profit_percent", "volume_usdt", "status", "details"]
+JOURNAL_BUFFER = []
+JOURNAL_FLUSH_EVENT = asyncio.Event()
+JOURNAL_SEGMENT = {"path": None}
+JOURNAL_LOCK = asyncio.Lock()
 TRIANGLE_CACHE = {}
 TRIANGLE_HOLD_TIME = 5  # Минимальный интервал для одного треугольника
 
@@ -29,6 +91,125 @@ MAX_TRADES_PER_MINUTE = int(os.getenv("MAX_TRADES_PER_MINUTE", "5"))
 MAX_TRADES_PER_HOUR = int(os.getenv("MAX_TRADES_PER_HOUR", "30"))
 MAX_TRADES_PER_DAY = int(os.getenv("MAX_TRADES_PER_DAY", "100"))
 
+# Лимиты API Bybit v5: 600 HTTP-запросов за 5 с на IP, создание спот-ордеров 20/с и баланс 50/с на UID.
+# Ведра токенов заданы с запасом; вес эндпоинта - сколько токенов списывает один вызов.
+RATE_LIMIT_BUCKETS = {
+    "public": {"rate": float(os.getenv("PUBLIC_RATE_LIMIT", "100")), "capacity": 100},
+    "order": {"rate": float(os.getenv("ORDER_RATE_LIMIT", "15")), "capacity": 15},
+    "account": {"rate": float(os.getenv("ACCOUNT_RATE_LIMIT", "10")), "capacity": 10}
+}
+ENDPOINT_WEIGHTS = {
+    "fetch_order_book": ("public", 1),
+    "fetch_ticker": ("public", 1),
+    "fetch_tickers": ("public", 1),
+    "fetch_time": ("public", 1),
+    "load_markets": ("public", 5),
+    "create_order": ("order", 1),
+    "fetch_balance": ("account", 1),
+    "fetch_trading_fees": ("account", 1)
+}
+RATE_LIMIT_BACKOFF = 5  # Пауза ведра после отказа 429, сек
+RATE_LIMIT_STATS = {"requests": 0, "throttled": 0, "rejections": 0}
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "20"))  # Максимум одновременных REST-запросов
+REQUEST_SEMAPHORE = asyncio.Semaphore(SCAN_CONCURRENCY)
+EXECUTION_LOCK = asyncio.Lock()
+
+# === Кэш стаканов ===
+ORDERBOOK_DEPTH = 20
+ORDERBOOK_CACHE_TTL = float(os.getenv("ORDERBOOK_CACHE_TTL", "2"))  # Максимальный возраст стакана, сек
+ORDERBOOK_CACHE_MAX_SIZE = int(os.getenv("ORDERBOOK_CACHE_MAX_SIZE", "1000"))
+ORDERBOOK_CACHE = {}  # symbol -> {"orderbook": ..., "fetched_at": ...}
+ORDERBOOK_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+ORDERBOOK_INFLIGHT = {}  # symbol -> задача загрузки, чтобы не запрашивать один стакан дважды
+
+# === Потоковые стаканы ===
+MARKET_DATA_MODE = os.getenv("MARKET_DATA_MODE", "rest").lower()  # rest | stream
+MARKET_DATA_REPLAY_FILE = os.getenv("MARKET_DATA_REPLAY_FILE")  # JSONL-запись потока вместо WebSocket
+STREAM_DEPTH_LIMIT = int(os.getenv("STREAM_DEPTH_LIMIT", "50"))  # Bybit spot: 1, 50, 200
+LOCAL_BOOKS = {}  # symbol -> {"book": OrderBook, "seq": ..., "synced": ..., "pending": [...]}
+STREAM_HEARTBEAT = {}  # symbol -> время последнего сообщения потока по символу (жизнь подписки)
+STREAM_MAX_PENDING = 1000  # Максимум дельт в буфере на время ресинхронизации
+RESYNC_TASKS = {}
+SUBSCRIPTIONS_CHANGED = asyncio.Event()  # Список символов потока изменился (обновление рынков)
+MARKET_REFRESH_INTERVAL = int(os.getenv("MARKET_REFRESH_INTERVAL", "900"))  # Сверка списка рынков с биржей, сек (0 - выключено)
+
+# === Запись стаканов и бэктест ===
+RECORD_BOOKS_DIR = os.getenv("RECORD_BOOKS_DIR")  # Каталог для записи стаканов (не задан - запись выключена)
+RECORD_ROTATE_SECONDS = int(os.getenv("RECORD_ROTATE_SECONDS", "3600"))
+RECORD_BUFFER = []
+RECORD_SEGMENT = {"path": None, "opened": 0, "header": None}
+BACKTEST_LATENCY_MS = float(os.getenv("BACKTEST_LATENCY_MS", "50"))  # Задержка от обнаружения до исполнения
+
+# === Событийная переоценка ===
+UPDATED_SYMBOLS = set()  # Символы, стаканы которых изменились с последней оценки
+BOOK_UPDATE_EVENT = asyncio.Event()
+BOOK_FINGERPRINTS = {}  # symbol -> последний виденный стакан (режим rest)
+
+# === Адаптивное расписание сканирования ===
+SCAN_SCHEDULER = os.getenv("SCAN_SCHEDULER", "adaptive").lower()  # adaptive | uniform (все стаканы каждый цикл)
+SCAN_BUDGET_SHARE = float(os.getenv("SCAN_BUDGET_SHARE", "0.8"))  # Доля публичного лимита API на стаканы за цикл
+COLD_SAMPLE_SHARE = float(os.getenv("COLD_SAMPLE_SHARE", "0.2"))  # Доля бюджета на давно не проверявшиеся маршруты
+SCHEDULER_DECAY = float(os.getenv("SCHEDULER_DECAY", "0.2"))  # Вес нового наблюдения в скользящей статистике
+TRIANGLE_STATS = {}  # треугольник -> {"spread", "volatility", "hit_rate", "scans"} по оценкам прибыли
+TRIANGLE_SCHEDULED = {}  # треугольник -> время последнего обновления его стаканов по расписанию
+BOOK_UPDATE_RATES = {}  # symbol -> доля REST-загрузок, в которых стакан изменился (скользящая)
+SCHEDULER_STATS = {}  # Распределение бюджета в последнем цикле
+
+# === Пакетная оценка ===
+SCORING_MODE = os.getenv("SCORING_MODE", "batch").lower()  # batch | scalar
+VERIFY_BATCH_SCORING = os.getenv("VERIFY_BATCH_SCORING", "false").lower() == "true"
+
+# === Исполнение ===
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "sequential").lower()  # sequential | parallel (нужны остатки во всех валютах)
+ORDER_TYPE = os.getenv("ORDER_TYPE", "market").lower()  # market | limit_ioc
+LIMIT_IOC_SLIPPAGE = float(os.getenv("LIMIT_IOC_SLIPPAGE", "0.0005"))  # Допуск цены IOC от цены стакана
+REBALANCE_MIN_USDT = float(os.getenv("REBALANCE_MIN_USDT", "5"))  # Минимальный перекос запаса для ребалансировки
+INVENTORY_DRIFT = {}  # currency -> отклонение запаса от исходного после параллельных сделок
+REBALANCE_TASKS = set()
+REBALANCE_LOCK = asyncio.Lock()
+
+# === Проверка свежести перед сделкой ===
+REVALIDATE_BEFORE_TRADE = os.getenv("REVALIDATE_BEFORE_TRADE", "true").lower() == "true"  # Переоценка цикла перед ордерами
+MAX_BOOK_AGE_MS = float(os.getenv("MAX_BOOK_AGE_MS", "2000"))  # Самый старый стакан шага на момент переоценки
+REVALIDATE_MIN_PROFIT = float(os.getenv("REVALIDATE_MIN_PROFIT")) if os.getenv("REVALIDATE_MIN_PROFIT") else None  # По умолчанию MIN_PROFIT
+
+# === Состояние аккаунта ===
+ACCOUNT_BALANCES = {}  # currency -> остаток, засевается один раз и обновляется по исполнениям
+ACCOUNT_STREAM = os.getenv("ACCOUNT_STREAM", "false").lower() == "true"  # Остатки из приватного потока watch_balance
+BALANCE_RECONCILE_INTERVAL = int(os.getenv("BALANCE_RECONCILE_INTERVAL", "300"))  # Сверка остатков с биржей, сек
+TICKER_CACHE = {}  # symbol -> тикер с 24ч объемом
+TICKER_REFRESH_INTERVAL = int(os.getenv("TICKER_REFRESH_INTERVAL", "60"))
+
+# === Дескрипторы маршрутов ===
+MARKET_RULES = {}  # symbol -> комиссия тейкера, шаг и минимумы объема; строится после load_markets
+ROUTES = {}  # треугольник -> дескриптор маршрута (пары, стороны, комиссии и лимиты шагов)
+
+# === Кэш быстрого старта ===
+WARM_START_CACHE = os.getenv("WARM_START_CACHE", "cache/markets.json.gz")  # Рынки и маршруты на диске (пусто - выключено)
+WARM_START_MAX_AGE = int(os.getenv("WARM_START_MAX_AGE", str(6 * 3600)))  # Старше - кэш не используется, сек
+WARM_START_VERSION = 1  # Меняется при изменении формата кэша
+WARM_START = {"loaded": False, "hash": None}
+
+# === Подбор объема сделки ===
+SIZING_MODE = os.getenv("SIZING_MODE", "fixed").lower()  # fixed - TARGET_VOLUME_USDT, optimal - по кривой глубины
+
+# === Метрики ===
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт HTTP-эндпоинта /metrics (0 - выключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_SUMMARY_INTERVAL = int(os.getenv("METRICS_SUMMARY_INTERVAL", "300"))  # Период сводки в лог, сек
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)  # мс
+SLIPPAGE_BUCKETS = (-50, -10, -5, -1, 0, 1, 5, 10, 25, 50, 100)  # б.п., положительное - хуже оценки
+HISTOGRAMS = {}  # name -> {"bounds", "buckets", "sum", "count"}
+COUNTERS = {}  # (name, labels) -> значение с момента запуска
+
+# === Шардирование сканера ===
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))  # Процессов-сканеров (0/1 - все в одном процессе)
+OPPORTUNITY_QUEUE_SIZE = int(os.getenv("OPPORTUNITY_QUEUE_SIZE", "1000"))
+EXECUTOR_RATE_SHARE = float(os.getenv("EXECUTOR_RATE_SHARE", "0.2"))  # Доля лимитов API исполнителя, остальное - сканерам
+SHARD_METRICS_INTERVAL = float(os.getenv("SHARD_METRICS_INTERVAL", "5"))  # Период отправки метрик сканера исполнителю, сек
+WORKER_METRICS = {}  # shard -> последний снимок гистограмм и счетчиков процесса-сканера
+SCAN_WORKERS = []  # Процессы-сканеры (только в процессе-исполнителе)
+
 # Глобальный счетчик сделок
 TRADE_COUNTER = {
     "minute": {"count": 0, "reset_time": 0},
@@ -45,9 +226,8 @@ def init_counters():
 
 # === Инициализация биржи ===
 exchange_config = {
-    "enableRateLimit": True,
-    "options": {"defaultType": "spot"},
-    "rateLimit": 300  # Задержка 300 мс между запросами
+    "enableRateLimit": False,  # Лимиты соблюдает call_exchange по ведрам RATE_LIMIT_BUCKETS
+    "options": {"defaultType": "spot"}
 }
 
 if TESTNET_MODE:
@@ -60,6 +240,8 @@ if TESTNET_MODE:
         }},
     })
     TARGET_VOLUME_USDT = float(os.getenv("TESTNET_TARGET_VOLUME", "10"))
+    MIN_TRADE_VOLUME_USDT = float(os.getenv("TESTNET_MIN_TRADE_VOLUME", "1"))
+    MAX_TRADE_VOLUME_USDT = float(os.getenv("TESTNET_MAX_TRADE_VOLUME", "100"))
     MIN_PROFIT = float(os.getenv("TESTNET_MIN_PROFIT", "0.01"))
     NETWORK_NAME = "Bybit Testnet"
 else:
@@ -68,38 +250,344 @@ else:
         "secret": os.getenv("BYBIT_MAINNET_API_SECRET"),
     })
     TARGET_VOLUME_USDT = float(os.getenv("MAINNET_TARGET_VOLUME", "100"))
+    MIN_TRADE_VOLUME_USDT = float(os.getenv("MAINNET_MIN_TRADE_VOLUME", "5"))
+    MAX_TRADE_VOLUME_USDT = float(os.getenv("MAINNET_MAX_TRADE_VOLUME", "1000"))
     MIN_PROFIT = float(os.getenv("MAINNET_MIN_PROFIT", "0.1"))
     NETWORK_NAME = "Bybit Mainnet"
 
-exchange = ccxt.bybit(exchange_config)
-
-# Инициализация файла лога
-if not os.path.exists(LOG_FILE):
-    with open(LOG_FILE, "w") as f:
-        f.write("timestamp,network,route,profit_percent,volume_usdt,status,details\n")
+exchange = None  # Клиент Bybit создает ensure_exchange при запуске, а не при импорте
 
 # Инициализация счетчиков сделок
 init_counters()
 
-# Инициализация бота Telegram
+# Бот Telegram запускает start_telegram в фоне в начале main_loop
 telegram_app = None
-if TELEGRAM_TOKEN and TELEGRAM_CHAT_ID:
-    telegram_app = Application.builder().token(TELEGRAM_TOKEN).build()
+telegram_task = None
+
+def ensure_exchange():
+    """Создает клиент Bybit при первом вызове"""
+    global exchange
+    if exchange is None:
+        started = time.perf_counter()
+        exchange = ccxt.bybit(exchange_config)
+        STARTUP["phases"]["exchange"] = time.perf_counter() - started
+    return exchange
+
+async def start_telegram():
+    """Создает и запускает бота Telegram в фоне; до этого уведомления копятся в очередях"""
+    global telegram_app, TELEGRAM_ENABLED
+    try:
+        started = time.perf_counter()
+        # Импорт в потоке, чтобы не останавливать уже идущее сканирование
+        telegram_ext = await asyncio.to_thread(importlib.import_module, "telegram.ext")
+        app = telegram_ext.Application.builder().token(TELEGRAM_TOKEN).build()
+        await app.initialize()
+        await app.start()
+        telegram_app = app
+        STARTUP["phases"]["telegram"] = time.perf_counter() - started
+    except Exception as e:
+        # Без бота очереди некому разбирать: выключаем уведомления, чтобы они не копились
+        print(f"Telegram init error: {str(e)}; notifications disabled")
+        TELEGRAM_ENABLED = False
+        DEBUG_HELD.clear()
+        for pending in (ALERT_QUEUE, DEBUG_QUEUE):
+            while not pending.empty():
+                pending.get_nowait()
+        return
+    await run_telegram_notifier()
+
+def launch_telegram():
+    """Запускает start_telegram в фоне один раз за процесс"""
+    global telegram_task
+    if telegram_task is None and TELEGRAM_ENABLED:
+        telegram_task = asyncio.create_task(start_telegram())
+    return telegram_task
+
+def report_first_scan(triangle_count, label="Bot"):
+    """Один раз сообщает время от загрузки модуля до первой оценки треугольников"""
+    if STARTUP["first_scan"] is not None or not triangle_count:
+        return None
+    STARTUP["first_scan"] = time.time() - STARTUP["started"]
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in STARTUP["phases"].items())
+    message = f"{label}: time to first scan {STARTUP['first_scan']:.2f}s ({triangle_count} triangles; {phases})"
+    print(message)
+    return message
 
 async def log_debug(message):
     """Логирование отладочной информации"""
     if DEBUG_MODE:
         timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[DEBUG {timestamp}] {message}")
-        if telegram_app:
+        if TELEGRAM_ENABLED:
+            # Не ждем Telegram: строка уходит в очередь, при переполнении отбрасывается
             try:
-                await telegram_app.bot.send_message(
-                    chat_id=TELEGRAM_CHAT_ID,
-                    text=f"<code>[DEBUG] {message}</code>",
-                    parse_mode=ParseMode.HTML
-                )
-            except:
-                pass
+                DEBUG_QUEUE.put_nowait(str(message))
+                NOTIFY_EVENT.set()
+            except asyncio.QueueFull:
+                NOTIFY_STATS["dropped"] += 1
+
+def debug_pending():
+    return bool(DEBUG_HELD) or not DEBUG_QUEUE.empty()
+
+def next_debug_line():
+    return DEBUG_HELD.pop() if DEBUG_HELD else DEBUG_QUEUE.get_nowait()
+
+def render_debug_line(line, count=1):
+    """Строка отладки в том виде, в каком уходит в Telegram (после экранирования HTML)"""
+    # Экранирование удлиняет текст до 6 раз: слишком длинную строку укорачиваем до него
+    line = line if len(line) * 6 < TELEGRAM_MAX_LENGTH // 2 else line[:TELEGRAM_MAX_LENGTH // 12] + "..."
+    return html.escape(f"[DEBUG] {line}" if count == 1 else f"[DEBUG] {line} (x{count})")
+
+def build_debug_batch():
+    """Собирает отладочные строки из очереди в одно сообщение.
+    
+    Длина считается по экранированному тексту; не поместившаяся строка остается для следующей пачки.
+    """
+    limit = TELEGRAM_MAX_LENGTH - 64  # Запас на строку о пропущенных
+    rendered = []
+    length = 0
+    if DEBUG_QUEUE.qsize() > TELEGRAM_QUEUE_SIZE // 2:
+        # Под нагрузкой отправляем сводку по типам строк вместо самих строк
+        counts = {}
+        while debug_pending():
+            key = " ".join(next_debug_line().split()[:2])
+            counts[key] = counts.get(key, 0) + 1
+        for key, count in sorted(counts.items(), key=lambda item: -item[1]):
+            text = render_debug_line(f"{key}... x{count}")
+            if length + len(text) + 1 > limit:
+                NOTIFY_STATS["dropped"] += count
+                continue
+            rendered.append(text)
+            length += len(text) + 1
+    else:
+        groups = []  # [строка, повторы]
+        while debug_pending():
+            line = next_debug_line()
+            if groups and groups[-1][0] == line:
+                old = render_debug_line(*groups[-1])
+                new = render_debug_line(line, groups[-1][1] + 1)
+            else:
+                old, new = "", render_debug_line(line)
+            grown = len(new) - len(old) + (0 if old else 1)
+            if length + grown > limit:
+                DEBUG_HELD.append(line)
+                break
+            if old:
+                groups[-1][1] += 1
+                rendered[-1] = new
+            else:
+                groups.append([line, 1])
+                rendered.append(new)
+            length += grown
+    
+    if NOTIFY_STATS["dropped"]:
+        rendered.append(html.escape(f"... {NOTIFY_STATS['dropped']} debug lines dropped"))
+        NOTIFY_STATS["dropped"] = 0
+    text = "\n".join(rendered)
+    return f"<pre>{text}</pre>"
+
+async def deliver_telegram(text):
+    """Отправляет одно сообщение, соблюдая RetryAfter от Telegram"""
+    from telegram.constants import ParseMode
+    from telegram.error import RetryAfter
+    
+    for attempt in range(3):
+        try:
+            await telegram_app.bot.send_message(
+                chat_id=TELEGRAM_CHAT_ID,
+                text=text,
+                parse_mode=ParseMode.HTML,
+                disable_web_page_preview=True
+            )
+            NOTIFY_STATS["sent"] += 1
+            return
+        except RetryAfter as e:
+            wait = e.retry_after
+            if hasattr(wait, "total_seconds"):
+                wait = wait.total_seconds()
+            await asyncio.sleep(wait)
+        except Exception as e:
+            print(f"Telegram send error: {str(e)}")
+            return
+
+async def drain_notifications():
+    """Отправляет все накопленные уведомления: сначала торговые, затем пачку отладки"""
+    while not ALERT_QUEUE.empty() or debug_pending() or NOTIFY_STATS["dropped"]:
+        if not ALERT_QUEUE.empty():
+            await deliver_telegram(ALERT_QUEUE.get_nowait())
+        else:
+            await deliver_telegram(build_debug_batch())
+        await asyncio.sleep(TELEGRAM_MIN_INTERVAL)
+
+async def run_telegram_notifier():
+    """Фоновая отправка уведомлений из очередей с учетом лимитов Telegram"""
+    while True:
+        await NOTIFY_EVENT.wait()
+        NOTIFY_EVENT.clear()
+        await drain_notifications()
+
+def observe(name, value, bounds=LATENCY_BUCKETS):
+    """Добавляет наблюдение в гистограмму"""
+    histogram = HISTOGRAMS.get(name)
+    if histogram is None:
+        histogram = HISTOGRAMS[name] = {"bounds": bounds, "buckets": [0] * len(bounds), "sum": 0.0, "count": 0}
+    for i, bound in enumerate(histogram["bounds"]):
+        if value <= bound:
+            histogram["buckets"][i] += 1
+            break
+    histogram["sum"] += value
+    histogram["count"] += 1
+
+def inc_counter(name, amount=1, **labels):
+    """Увеличивает счетчик (метки - как в Prometheus)"""
+    key = (name, tuple(sorted(labels.items())))
+    COUNTERS[key] = COUNTERS.get(key, 0) + amount
+
+def histogram_quantile(histogram, q):
+    """Оценивает квантиль по верхним границам корзин"""
+    rank = q * histogram["count"]
+    seen = 0
+    for bound, count in zip(histogram["bounds"], histogram["buckets"]):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+def metrics_snapshot():
+    """Копия гистограмм и счетчиков процесса, пригодная для передачи в другой процесс"""
+    return {
+        "histograms": {name: dict(histogram, buckets=list(histogram["buckets"])) for name, histogram in HISTOGRAMS.items()},
+        "counters": dict(COUNTERS)
+    }
+
+def merged_metrics():
+    """Метрики этого процесса вместе с последними снимками процессов-сканеров"""
+    if not WORKER_METRICS:
+        return HISTOGRAMS, COUNTERS
+    merged = metrics_snapshot()
+    histograms, counters = merged["histograms"], merged["counters"]
+    for snapshot in WORKER_METRICS.values():
+        for name, histogram in snapshot["histograms"].items():
+            target = histograms.get(name)
+            if target is None:
+                histograms[name] = dict(histogram, buckets=list(histogram["buckets"]))
+                continue
+            target["buckets"] = [a + b for a, b in zip(target["buckets"], histogram["buckets"])]
+            target["sum"] += histogram["sum"]
+            target["count"] += histogram["count"]
+        for key, value in snapshot["counters"].items():
+            counters[key] = counters.get(key, 0) + value
+    return histograms, counters
+
+def render_metrics():
+    """Отдает метрики в текстовом формате Prometheus"""
+    histograms, counters = merged_metrics()
+    lines = []
+    for name, histogram in sorted(histograms.items()):
+        lines.append(f"# TYPE arb_{name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram["bounds"], histogram["buckets"]):
+            cumulative += count
+            lines.append(f'arb_{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'arb_{name}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f"arb_{name}_sum {histogram['sum']}")
+        lines.append(f"arb_{name}_count {histogram['count']}")
+    
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE arb_{name} counter")
+            typed.add(name)
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"arb_{name}{{{label_text}}} {value}" if labels else f"arb_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def summarize_metrics():
+    """Короткая сводка гистограмм и счетчиков для лога"""
+    histograms, counters = merged_metrics()
+    parts = []
+    for name, histogram in sorted(histograms.items()):
+        if histogram["count"]:
+            parts.append(
+                f"{name}: n={histogram['count']} avg={histogram['sum'] / histogram['count']:.2f} "
+                f"p50<={histogram_quantile(histogram, 0.5)} p95<={histogram_quantile(histogram, 0.95)}"
+            )
+    for (name, labels), value in sorted(counters.items()):
+        label_text = ",".join(f"{k}={v}" for k, v in labels)
+        parts.append(f"{name}{'[' + label_text + ']' if labels else ''}={value}")
+    return "; ".join(parts) or "no samples"
+
+async def handle_metrics_request(reader, writer):
+    """Минимальный HTTP-обработчик: на любой GET отдает /metrics"""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render_metrics().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+async def run_metrics_server():
+    """Локальный эндпоинт метрик для Prometheus"""
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    print(f"Metrics endpoint: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    async with server:
+        await server.serve_forever()
+
+async def acquire_rate_limit(endpoint, buckets=None):
+    """Списывает токены из ведра эндпоинта, ожидая пополнения при необходимости"""
+    bucket_name, weight = ENDPOINT_WEIGHTS.get(endpoint, ("public", 1))
+    bucket = (buckets or RATE_LIMIT_BUCKETS)[bucket_name]
+    if "lock" not in bucket:
+        bucket.update(tokens=bucket["capacity"], updated=time.monotonic(), blocked_until=0, lock=asyncio.Lock())
+    
+    async with bucket["lock"]:
+        while True:
+            now = time.monotonic()
+            bucket["tokens"] = min(bucket["capacity"], bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+            bucket["updated"] = now
+            
+            if now >= bucket["blocked_until"] and bucket["tokens"] >= weight:
+                bucket["tokens"] -= weight
+                return
+            
+            RATE_LIMIT_STATS["throttled"] += 1
+            inc_counter("rate_limit_throttled_total", bucket=bucket_name)
+            wait = max(bucket["blocked_until"] - now, (weight - bucket["tokens"]) / bucket["rate"])
+            await asyncio.sleep(wait)
+
+async def call_exchange(endpoint, *args, venue=None, **kwargs):
+    """Вызывает метод биржи с учетом весов эндпоинтов и ограничением параллельности"""
+    client = venue["exchange"] if venue else exchange
+    buckets = venue["buckets"] if venue else RATE_LIMIT_BUCKETS
+    for attempt in range(3):
+        await acquire_rate_limit(endpoint, buckets)
+        async with REQUEST_SEMAPHORE:
+            RATE_LIMIT_STATS["requests"] += 1
+            try:
+                return await getattr(client, endpoint)(*args, **kwargs)
+            except (ccxt.RateLimitExceeded, ccxt.DDoSProtection) as e:
+                # 429: останавливаем ведро и повторяем после паузы
+                RATE_LIMIT_STATS["rejections"] += 1
+                inc_counter("rate_limit_rejections_total", endpoint=endpoint, venue=venue["id"] if venue else PRIMARY_VENUE)
+                bucket = buckets[ENDPOINT_WEIGHTS.get(endpoint, ("public", 1))[0]]
+                bucket["tokens"] = 0
+                bucket["blocked_until"] = time.monotonic() + RATE_LIMIT_BACKOFF
+                await log_debug(f"Rate limit hit on {endpoint} ({venue['id'] if venue else PRIMARY_VENUE}): {str(e)}")
+                if attempt == 2:
+                    raise
+
+def reset_rate_limit_stats():
+    """Возвращает статистику запросов за цикл и обнуляет счетчики"""
+    stats = dict(RATE_LIMIT_STATS)
+    for key in RATE_LIMIT_STATS:
+        RATE_LIMIT_STATS[key] = 0
+    return stats
 
 async def check_rate_limits():
     """Проверяет и сбрасывает счетчики лимитов"""
@@ -128,7 +616,10 @@ async def check_volume_limits(symbol, volume):
         if TESTNET_MODE:
             return True
             
-        ticker = await exchange.fetch_ticker(symbol)
+        # Тикеры обновляет фоновая задача refresh_tickers_loop
+        ticker = TICKER_CACHE.get(symbol)
+        if not ticker or not ticker.get('quoteVolume'):
+            return True
         daily_volume = ticker['quoteVolume']  # Объем в USDT
         
         # Не более 1% от дневного объема
@@ -142,57 +633,249 @@ async def check_volume_limits(symbol, volume):
 async def load_symbols():
     try:
         await log_debug("Loading markets...")
-        markets = await exchange.load_markets()
-        symbols = [symbol for symbol, market in markets.items() if market['active']]
+        markets = await call_exchange("load_markets")
+        symbols = [symbol for symbol, market in markets.items() if market['active'] and market.get('spot', True)]
         await log_debug(f"Loaded {len(symbols)} active symbols")
         return symbols, markets
     except Exception as e:
         await log_debug(f"Market load error: {str(e)}")
         return [], {}
 
-async def find_triangles(symbols):
+def build_currency_graph(markets):
+    """Строит граф валют: валюта -> {соседняя валюта: торговая пара}"""
+    graph = {}
+    for symbol, market in markets.items():
+        if not market.get('active') or not market.get('spot', True):
+            continue
+        base, quote = market['base'], market['quote']
+        graph.setdefault(base, {})[quote] = symbol
+        graph.setdefault(quote, {})[base] = symbol
+    return graph
+
+async def find_triangles(markets):
+    """Перебирает циклы в графе валют, начинающиеся и заканчивающиеся в START_COINS"""
+    started = time.perf_counter()
+    graph = build_currency_graph(markets)
     triangles = []
-    symbol_set = set(symbols)
     
     for base in START_COINS:
-        base_pairs = [s for s in symbols if base in s]
-        await log_debug(f"Found {len(base_pairs)} pairs for {base}")
+        neighbors = graph.get(base, {})
+        found = 0
         
-        for s1 in base_pairs:
-            currencies = s1.split('/')
-            if base == currencies[0]:
-                mid1 = currencies[1]
-            else:
-                mid1 = currencies[0]
+        for mid1 in neighbors:
+            for mid2 in graph[mid1]:
+                if mid2 == base:
+                    continue
+                if base in graph[mid2]:
+                    triangles.append((base, mid1, mid2))
+                    found += 1
                 
-            for s2 in symbols:
-                if s1 == s2:
+                if MAX_CYCLE_LENGTH < 4:
                     continue
-                    
-                if mid1 in s2:
-                    currencies2 = s2.split('/')
-                    if mid1 == currencies2[0]:
-                        mid2 = currencies2[1]
-                    else:
-                        mid2 = currencies2[0]
-                        
-                    s3 = f"{mid2}/{base}"
-                    if s3 in symbol_set:
-                        triangles.append((base, mid1, mid2))
-                        await log_debug(f"Triangle found: {base}->{mid1}->{mid2}")
-                    else:
-                        s3 = f"{base}/{mid2}"
-                        if s3 in symbol_set:
-                            triangles.append((base, mid1, mid2))
-                            await log_debug(f"Triangle found: {base}->{mid1}->{mid2}")
-    
-    await log_debug(f"Total triangles: {len(triangles)}")
-    return list(set(triangles))
-
-async def get_avg_price(orderbook_side, target_amount):
+                for mid3 in graph[mid2]:
+                    if mid3 in (base, mid1):
+                        continue
+                    if base in graph[mid3]:
+                        triangles.append((base, mid1, mid2, mid3))
+                        found += 1
+        
+        await log_debug(f"Found {len(neighbors)} pairs and {found} cycles for {base}")
+    
+    elapsed = time.perf_counter() - started
+    await log_debug(f"Total triangles: {len(triangles)} (discovered in {elapsed * 1000:.1f} ms)")
+    return triangles
+
+def build_symbol_index(triangles, symbols):
+    """Строит обратный индекс: торговая пара -> треугольники, в которые она входит"""
+    symbol_set = set(symbols)
+    symbol_index = {}
+    for triangle in triangles:
+        route = ROUTES.get(triangle)
+        for symbol in route["symbols"] if route else [s for s, _ in triangle_legs(triangle, symbol_set)]:
+            symbol_index.setdefault(symbol, []).append(triangle)
+    return symbol_index
+
+def mark_symbol_updated(symbol):
+    """Помечает стакан символа как изменившийся и будит оценщик"""
+    UPDATED_SYMBOLS.add(symbol)
+    BOOK_UPDATE_EVENT.set()
+
+class BookSide:
+    """Сторона стакана в массивах: уровни от лучшей цены и накопленные суммы для бинарного поиска.
+    
+    Первая оценка после изменения идет линейным проходом, как у списков ccxt; накопленные суммы
+    строятся только если сторону оценивают повторно до следующего изменения.
+    """
+    __slots__ = ("prices", "sizes", "count", "descending", "cum_quote", "cum_base", "walked", "plain")
+    
+    def __init__(self, capacity, descending):
+        self.prices = np.zeros(capacity)
+        self.sizes = np.zeros(capacity)
+        self.count = 0
+        self.descending = descending  # bids - по убыванию цены, asks - по возрастанию
+        self.cum_quote = None
+        self.cum_base = None
+        self.walked = False
+        self.plain = None  # Уровни снапшота списками для первого прохода, пока не было update
+    
+    def load(self, levels):
+        """Заменяет уровни снапшотом (уровни в формате ccxt [[price, size], ...])"""
+        self.cum_quote = None
+        self.walked = False
+        self.plain = None
+        prices = [float(level[0]) for level in levels]
+        sizes = [float(level[1]) for level in levels]
+        pairs = zip(prices, prices[1:])
+        ordered = all(a > b for a, b in pairs) if self.descending else all(a < b for a, b in pairs)
+        if ordered and (not sizes or min(sizes) > 0):
+            # Обычный снапшот ccxt: уже отсортирован, без повторов и нулей
+            n = min(len(prices), len(self.prices))
+            self.prices[:n] = prices[:n]
+            self.sizes[:n] = sizes[:n]
+            self.count = n
+            self.plain = (prices[:n], sizes[:n])
+            return
+        
+        levels = dict(zip(prices, sizes))  # Повтор цены - берется последний
+        levels = np.asarray(list(levels.items()), dtype=float).reshape(-1, 2)
+        levels = levels[levels[:, 1] > 0]
+        order = np.argsort(-levels[:, 0] if self.descending else levels[:, 0], kind="stable")
+        levels = levels[order][:len(self.prices)]
+        self.count = len(levels)
+        self.prices[:self.count] = levels[:, 0]
+        self.sizes[:self.count] = levels[:, 1]
+    
+    def update(self, price, size):
+        """Точечно обновляет уровень на месте; нулевой объем удаляет уровень"""
+        n = self.count
+        if self.descending:
+            i = n - int(np.searchsorted(self.prices[:n][::-1], price, side="right"))
+        else:
+            i = int(np.searchsorted(self.prices[:n], price))
+        
+        if i < n and self.prices[i] == price:
+            if size == 0:
+                self.prices[i:n - 1] = self.prices[i + 1:n]
+                self.sizes[i:n - 1] = self.sizes[i + 1:n]
+                self.count = n - 1
+            else:
+                self.sizes[i] = size
+        elif size > 0:
+            capacity = len(self.prices)
+            if i >= capacity:
+                return  # Хуже всех хранимых уровней
+            n = min(n, capacity - 1)  # Переполнение вытесняет самый дальний уровень
+            self.prices[i + 1:n + 1] = self.prices[i:n]
+            self.sizes[i + 1:n + 1] = self.sizes[i:n]
+            self.prices[i] = price
+            self.sizes[i] = size
+            self.count = n + 1
+        else:
+            return
+        self.cum_quote = None
+        self.walked = False
+        self.plain = None
+    
+    def cumulative(self):
+        """Накопленные суммы (котируемая, базовая) - считаются один раз до следующего изменения"""
+        if self.cum_quote is None:
+            # Списки, а не массивы: bisect по ним быстрее searchsorted на малой глубине
+            self.cum_quote = np.cumsum(self.prices[:self.count] * self.sizes[:self.count]).tolist()
+            self.cum_base = np.cumsum(self.sizes[:self.count]).tolist()
+        return self.cum_quote, self.cum_base
+    
+    def fill_price(self, target_amount):
+        """То же, что get_avg_price; повторные оценки - бинарным поиском по накопленным суммам"""
+        if self.cum_quote is None and not self.walked:
+            self.walked = True
+            n = self.count
+            prices, sizes = self.plain or (self.prices[:n].tolist(), self.sizes[:n].tolist())
+            return walk_avg_price(zip(prices, sizes), target_amount)
+        
+        cum_quote, cum_base = self.cumulative()
+        i = bisect.bisect_left(cum_quote, target_amount)
+        if i >= self.count:
+            total_quote = cum_quote[-1] if self.count else 0
+            return None, total_quote, total_quote
+        
+        prev_quote = cum_quote[i - 1] if i else 0.0
+        prev_base = cum_base[i - 1] if i else 0.0
+        total_base = prev_base + (target_amount - prev_quote) / float(self.prices[i])
+        return target_amount / total_base, target_amount, target_amount
+    
+    def tolist(self):
+        return np.column_stack((self.prices[:self.count], self.sizes[:self.count])).tolist()
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        return iter(self.tolist())
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.tolist()[index]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return [float(self.prices[index]), float(self.sizes[index])]
+    
+    def __eq__(self, other):
+        if not isinstance(other, BookSide):
+            return NotImplemented
+        n = self.count
+        return n == other.count and np.array_equal(self.prices[:n], other.prices[:n]) \
+            and np.array_equal(self.sizes[:n], other.sizes[:n])
+    
+    __hash__ = None
+
+class OrderBook:
+    """Стакан в массивах фиксированной глубины; читается как словарь ccxt (book['bids'][0][0] и т.п.)"""
+    __slots__ = ("symbol", "bids", "asks", "timestamp", "nonce")
+    
+    def __init__(self, symbol, capacity):
+        self.symbol = symbol
+        self.bids = BookSide(capacity, descending=True)
+        self.asks = BookSide(capacity, descending=False)
+        self.timestamp = None
+        self.nonce = None
+    
+    @classmethod
+    def from_ccxt(cls, orderbook, capacity=None):
+        book = cls(orderbook.get("symbol"), capacity or max(len(orderbook["bids"]), len(orderbook["asks"]), 1))
+        book.bids.load(orderbook["bids"])
+        book.asks.load(orderbook["asks"])
+        book.timestamp = orderbook.get("timestamp")
+        book.nonce = orderbook.get("nonce")
+        return book
+    
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+def book_levels(side, depth=None):
+    """Уровни стороны стакана как массивы (цены, объемы) для обоих форматов стакана"""
+    if isinstance(side, BookSide):
+        n = side.count if depth is None else min(depth, side.count)
+        return side.prices[:n], side.sizes[:n]
+    levels = np.asarray([level[:2] for level in side[:depth]], dtype=float).reshape(-1, 2)
+    return levels[:, 0], levels[:, 1]
+
+def get_avg_price(orderbook_side, target_amount):
+    if isinstance(orderbook_side, BookSide):
+        return orderbook_side.fill_price(target_amount)
+    return walk_avg_price(orderbook_side, target_amount)
+
+def walk_avg_price(levels, target_amount):
+    """Средняя цена исполнения на target_amount котируемой валюты линейным проходом по уровням"""
     total_base = 0
     total_quote = 0
-    for price, volume in orderbook_side:
+    for price, volume in levels:
         price = float(price)
         volume = float(volume)
         quote_amount = price * volume
@@ -201,7 +884,7 @@ async def get_avg_price(orderbook_side, target_amount):
             remaining = target_amount - total_quote
             volume_used = remaining / price
             total_base += volume_used
-            total_quote += remaining
+            total_quote = target_amount  # Не через сложение: округление дало бы total_quote < target_amount
             break
         else:
             total_base += volume
@@ -213,261 +896,1693 @@ async def get_avg_price(orderbook_side, target_amount):
     avg_price = total_quote / total_base
     return avg_price, total_quote, total_quote
 
+def evict_orderbook_cache(cache=None):
+    """Удаляет устаревшие стаканы и ограничивает размер кэша"""
+    cache = ORDERBOOK_CACHE if cache is None else cache
+    now = time.time()
+    expired = [s for s, entry in cache.items() if now - entry["fetched_at"] > ORDERBOOK_CACHE_TTL]
+    for symbol in expired:
+        del cache[symbol]
+    
+    # Вытесняем самые старые записи (порядок вставки = порядок загрузки)
+    overflow = len(cache) - ORDERBOOK_CACHE_MAX_SIZE
+    for symbol in list(cache)[:max(0, overflow)]:
+        del cache[symbol]
+    
+    ORDERBOOK_CACHE_STATS["evictions"] += len(expired) + max(0, overflow)
+
+def reset_orderbook_cache_stats():
+    """Возвращает статистику кэша за цикл и обнуляет счетчики"""
+    stats = dict(ORDERBOOK_CACHE_STATS)
+    for key in ORDERBOOK_CACHE_STATS:
+        ORDERBOOK_CACHE_STATS[key] = 0
+    return stats
+
+async def get_order_book(symbol, venue=None):
+    """Возвращает стакан из кэша или загружает его с биржи (venue - дополнительная площадка)"""
+    if venue is None and MARKET_DATA_MODE == "stream":
+        return get_local_order_book(symbol)
+    
+    cache = venue["orderbook_cache"] if venue else ORDERBOOK_CACHE
+    inflight = venue["inflight"] if venue else ORDERBOOK_INFLIGHT
+    entry = cache.get(symbol)
+    if entry and time.time() - entry["fetched_at"] <= ORDERBOOK_CACHE_TTL:
+        ORDERBOOK_CACHE_STATS["hits"] += 1
+        inc_counter("orderbook_cache_hits_total")
+        return entry["orderbook"]
+    
+    # Параллельные запросы одного символа ждут уже идущую загрузку
+    task = inflight.get(symbol)
+    if task:
+        ORDERBOOK_CACHE_STATS["hits"] += 1
+        inc_counter("orderbook_cache_hits_total")
+    else:
+        ORDERBOOK_CACHE_STATS["misses"] += 1
+        inc_counter("orderbook_cache_misses_total")
+        task = inflight[symbol] = asyncio.ensure_future(fetch_order_book_to_cache(symbol, venue))
+    return await asyncio.shield(task)
+
+async def fetch_order_book_to_cache(symbol, venue=None):
+    """Загружает стакан через REST и кладет его в кэш площадки"""
+    cache = venue["orderbook_cache"] if venue else ORDERBOOK_CACHE
+    try:
+        await log_debug(f"Fetching orderbook for {symbol}" + (f" on {venue['id']}" if venue else ""))
+        started = time.perf_counter()
+        orderbook = await call_exchange("fetch_order_book", symbol, limit=ORDERBOOK_DEPTH, venue=venue)
+        observe("book_fetch_ms", (time.perf_counter() - started) * 1000)
+        orderbook = OrderBook.from_ccxt(orderbook, ORDERBOOK_DEPTH)
+        
+        cache.pop(symbol, None)
+        cache[symbol] = {"orderbook": orderbook, "fetched_at": time.time()}
+        if len(cache) > ORDERBOOK_CACHE_MAX_SIZE:
+            evict_orderbook_cache(cache)
+        return orderbook
+    finally:
+        # Снимаем только свою запись: чужую загрузку того же символа другие запросы еще ждут
+        inflight = venue["inflight"] if venue else ORDERBOOK_INFLIGHT
+        if inflight.get(symbol) is asyncio.current_task():
+            del inflight[symbol]
+
+async def refetch_order_book(symbol):
+    """Загружает стакан заново мимо TTL кэша; уже идущую загрузку символа переиспользует"""
+    task = ORDERBOOK_INFLIGHT.get(symbol)
+    if task is None:
+        task = ORDERBOOK_INFLIGHT[symbol] = asyncio.ensure_future(fetch_order_book_to_cache(symbol))
+    return await asyncio.shield(task)
+
 async def get_execution_price(symbol, side, target_amount):
     try:
-        await log_debug(f"Fetching orderbook for {symbol}")
-        orderbook = await exchange.fetch_order_book(symbol, limit=20)
+        orderbook = await get_order_book(symbol)
+        if orderbook is None:
+            return None, 0, 0
         
         if side == "buy":
-            return await get_avg_price(orderbook['asks'], target_amount)
+            return get_avg_price(orderbook['asks'], target_amount)
         else:
-            return await get_avg_price(orderbook['bids'], target_amount)
+            return get_avg_price(orderbook['bids'], target_amount)
     except Exception as e:
+        inc_counter("errors_total", stage="orderbook")
         await log_debug(f"Orderbook error for {symbol}: {str(e)}")
         return None, 0, 0
 
-async def send_telegram_message(text):
-    if not telegram_app or not TELEGRAM_CHAT_ID:
-        return
-        
+def apply_levels(side, levels):
+    """Применяет уровни к стороне стакана (нулевой объем удаляет уровень)"""
+    for price, volume in levels:
+        side.update(float(price), float(volume))
+
+def apply_snapshot(book, message):
+    """Заменяет стакан снапшотом и доигрывает накопленные дельты"""
+    book["book"].bids.load(message["bids"])
+    book["book"].asks.load(message["asks"])
+    book["seq"] = message.get("seq")
+    book["timestamp"] = book["book"].timestamp = message.get("timestamp")
+    book["received_at"] = time.time()
+    book["book"].nonce = book["seq"]
+    book["synced"] = True
+    inc_counter("stream_events_total", kind="snapshot")
+    
+    pending, book["pending"] = book["pending"], []
+    for delta in pending:
+        if book["seq"] is not None and delta.get("seq") is not None and delta["seq"] <= book["seq"]:
+            continue
+        if not apply_delta(book, delta):
+            return False
+    return True
+
+def apply_delta(book, message):
+    """Применяет дельту; при разрыве последовательности помечает стакан для ресинхронизации"""
+    if not book["synced"]:
+        book["pending"].append(message)
+        del book["pending"][:-STREAM_MAX_PENDING]
+        return False
+    
+    seq = message.get("seq")
+    if seq is not None and book["seq"] is not None:
+        if seq <= book["seq"]:
+            return True  # Дубликат или устаревшая дельта
+        if seq != book["seq"] + 1:
+            inc_counter("stream_events_total", kind="gap")
+            book["synced"] = False
+            book["pending"] = [message]
+            return False
+    
+    apply_levels(book["book"].bids, message["bids"])
+    apply_levels(book["book"].asks, message["asks"])
+    book["seq"] = book["book"].nonce = seq
+    book["timestamp"] = book["book"].timestamp = message.get("timestamp")
+    book["received_at"] = time.time()
+    inc_counter("stream_events_total", kind="delta")
+    return True
+
+def apply_book_message(message):
+    """Применяет сообщение потока к локальному стакану; False - стакан требует ресинхронизации"""
+    STREAM_HEARTBEAT[message["symbol"]] = time.time()
+    book = LOCAL_BOOKS.get(message["symbol"])
+    if book is None:
+        # Запас глубины сверх STREAM_DEPTH_LIMIT: дельты могут удалить верхние уровни
+        book = LOCAL_BOOKS[message["symbol"]] = {
+            "book": OrderBook(message["symbol"], STREAM_DEPTH_LIMIT * 2), "seq": None, "timestamp": None,
+            "received_at": None, "synced": False, "pending": []
+        }
+    if message["type"] == "snapshot":
+        applied = apply_snapshot(book, message)
+    else:
+        applied = apply_delta(book, message)
+    
+    if applied:
+        mark_symbol_updated(message["symbol"])
+    if RECORD_BOOKS_DIR:
+        record_book_message(message)
+    return applied
+
+def get_local_order_book(symbol):
+    """Возвращает локальный стакан в формате ccxt без сетевых запросов"""
+    book = LOCAL_BOOKS.get(symbol)
+    if not book or not book["synced"]:
+        return None
+    return book["book"]
+
+def latest_order_book(symbol):
+    """Последний известный стакан без сетевых запросов и без учета TTL: (стакан, время получения) или None"""
+    book = LOCAL_BOOKS.get(symbol)
+    if book and book["synced"]:
+        return book["book"], book["received_at"]
+    entry = ORDERBOOK_CACHE.get(symbol)
+    if entry:
+        return entry["orderbook"], entry["fetched_at"]
+    return None
+
+def book_confirmed_at(symbol):
+    """Время, на которое стакан заведомо актуален, или None.
+    
+    Потоковый стакан без изменений не устаревает, пока жива подписка на этот символ: берется
+    последнее сообщение потока по символу. REST-стакан актуален на момент загрузки.
+    """
+    book = LOCAL_BOOKS.get(symbol)
+    if book and book["synced"]:
+        return max(book["received_at"], STREAM_HEARTBEAT.get(symbol, 0))
+    entry = ORDERBOOK_CACHE.get(symbol)
+    return entry["fetched_at"] if entry else None
+
+def orderbook_to_message(symbol, orderbook):
+    """Преобразует стакан ccxt в снапшот потока"""
+    return {
+        "symbol": symbol,
+        "type": "snapshot",
+        "seq": orderbook.get("nonce"),
+        "timestamp": orderbook.get("timestamp"),
+        "bids": orderbook["bids"].tolist() if isinstance(orderbook, OrderBook) else orderbook["bids"],
+        "asks": orderbook["asks"].tolist() if isinstance(orderbook, OrderBook) else orderbook["asks"]
+    }
+
+async def resync_local_book(symbol):
+    """Восстанавливает стакан после разрыва последовательности через REST-снапшот"""
     try:
-        await telegram_app.bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID, 
-            text=text, 
-            parse_mode=ParseMode.HTML,
-            disable_web_page_preview=True
-        )
+        inc_counter("stream_events_total", kind="resync")
+        await log_debug(f"Resyncing orderbook for {symbol}")
+        orderbook = await call_exchange("fetch_order_book", symbol, limit=STREAM_DEPTH_LIMIT)
+        apply_book_message(orderbook_to_message(symbol, orderbook))
     except Exception as e:
-        await log_debug(f"Telegram send error: {str(e)}")
+        await log_debug(f"Resync error for {symbol}: {str(e)}")
+    finally:
+        RESYNC_TASKS.pop(symbol, None)
+
+def create_stream_client():
+    """Клиент ccxt.pro Bybit; в тестовой сети и websocket-хосты тестовые, а не только REST"""
+    import ccxt.pro as ccxtpro
+    
+    client = ccxtpro.bybit(exchange_config)
+    client.set_sandbox_mode(TESTNET_MODE)
+    return client
 
-def log_trade(base, mid1, mid2, profit, volume, status, details=""):
+async def ccxtpro_feed(symbols):
+    """Поток стаканов через watch_order_book (ccxt.pro)"""
+    client = create_stream_client()
+    queue = asyncio.Queue()
+    
+    async def watch(symbol):
+        while True:
+            try:
+                orderbook = await client.watch_order_book(symbol, limit=STREAM_DEPTH_LIMIT)
+                await queue.put(orderbook_to_message(symbol, orderbook))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await log_debug(f"Stream error for {symbol}: {str(e)}")
+                await asyncio.sleep(5)
+    
+    tasks = {}
+    
+    async def resubscribe():
+        # Подписки следуют за списком symbols, который меняет обновление рынков
+        while True:
+            wanted = set(symbols)
+            for symbol in wanted - set(tasks):
+                tasks[symbol] = asyncio.create_task(watch(symbol))
+            for symbol in set(tasks) - wanted:
+                tasks.pop(symbol).cancel()
+            await SUBSCRIPTIONS_CHANGED.wait()
+            SUBSCRIPTIONS_CHANGED.clear()
+    
+    manager = asyncio.create_task(resubscribe())
     try:
-        with open(LOG_FILE, "a") as f:
-            route = f"{base}->{mid1}->{mid2}->{base}"
-            f.write(f"{datetime.utcnow()},{NETWORK_NAME},{route},{profit:.4f},{volume},{status},{details}\n")
+        while True:
+            yield await queue.get()
+    finally:
+        manager.cancel()
+        for task in tasks.values():
+            task.cancel()
+        await client.close()
+
+async def replay_feed(path, symbols):
+    """Поток стаканов из JSONL-файла (одно сообщение snapshot/delta на строку)"""
+    symbol_set = set(symbols)
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if message.get("symbol") in symbol_set:
+                yield message
+            await asyncio.sleep(0)
+
+def get_market_data_feed(symbols):
+    """Выбирает источник потока: запись из файла или WebSocket биржи"""
+    if MARKET_DATA_REPLAY_FILE:
+        return replay_feed(MARKET_DATA_REPLAY_FILE, symbols)
+    return ccxtpro_feed(symbols)
+
+async def run_market_data_stream(symbols, feed=None, resync=resync_local_book):
+    """Поддерживает локальные стаканы для всех символов из потока"""
+    feed = feed or get_market_data_feed(symbols)
+    await log_debug(f"Streaming orderbooks for {len(symbols)} symbols")
+    async for message in feed:
+        if not apply_book_message(message):
+            symbol = message["symbol"]
+            if symbol not in RESYNC_TASKS:
+                RESYNC_TASKS[symbol] = asyncio.create_task(resync(symbol))
+
+async def refresh_order_books(symbols):
+    """Параллельно обновляет стаканы через REST и помечает изменившиеся символы"""
+    orderbooks = await asyncio.gather(*(get_order_book(symbol) for symbol in symbols), return_exceptions=True)
+    for symbol, orderbook in zip(symbols, orderbooks):
+        if isinstance(orderbook, Exception):
+            inc_counter("errors_total", stage="orderbook")
+            await log_debug(f"Orderbook error for {symbol}: {str(orderbook)}")
+            continue
+        
+        fingerprint = (orderbook["bids"], orderbook["asks"])
+        changed = BOOK_FINGERPRINTS.get(symbol) != fingerprint
+        rate = BOOK_UPDATE_RATES.get(symbol, 1.0)
+        BOOK_UPDATE_RATES[symbol] = rate + SCHEDULER_DECAY * (changed - rate)
+        if changed:
+            BOOK_FINGERPRINTS[symbol] = fingerprint
+            mark_symbol_updated(symbol)
+            if RECORD_BOOKS_DIR:
+                record_book_message(orderbook_to_message(symbol, orderbook))
+
+def record_triangle_profit(triangle, profit_percent):
+    """Обновляет скользящую статистику маршрута: средний спред, его изменчивость и долю находок.
+    
+    NaN - маршрут оценен, но объем не набирается в стаканах: считается промахом без спреда.
+    """
+    stats = TRIANGLE_STATS.get(triangle)
+    if stats is None:
+        stats = TRIANGLE_STATS[triangle] = {"spread": None, "volatility": 0.0, "hit_rate": 0.0, "scans": 0}
+    stats["scans"] += 1
+    if not np.isfinite(profit_percent):
+        stats["hit_rate"] -= SCHEDULER_DECAY * stats["hit_rate"]
+        return
+    
+    hit = float(MIN_PROFIT <= profit_percent <= MAX_PROFIT)
+    if stats["spread"] is None:
+        stats.update(spread=profit_percent, hit_rate=hit)
+        return
+    stats["volatility"] += SCHEDULER_DECAY * (abs(profit_percent - stats["spread"]) - stats["volatility"])
+    stats["spread"] += SCHEDULER_DECAY * (profit_percent - stats["spread"])
+    stats["hit_rate"] += SCHEDULER_DECAY * (hit - stats["hit_rate"])
+
+def triangle_priority(triangle, route):
+    """Приоритет маршрута, %: спред плюс две изменчивости, если стаканы вообще меняются, и до 1 п.п. за находки"""
+    stats = TRIANGLE_STATS.get(triangle)
+    if stats is None:
+        return float("inf")  # Новый маршрут оценивается хотя бы раз
+    if stats["spread"] is None:
+        return float("-inf")  # Ни разу не набрал объем: только выборка холодных маршрутов
+    update_rate = sum(BOOK_UPDATE_RATES.get(symbol, 1.0) for symbol in route["symbols"]) / len(route["symbols"])
+    return stats["spread"] + 2 * stats["volatility"] * update_rate + stats["hit_rate"]
+
+def schedule_book_fetches(triangles, markets, book_symbols):
+    """Выбирает стаканы для REST-обновления в пределах бюджета лимита API на цикл.
+    
+    Сначала стаканы маршрутов с наибольшим приоритетом (очередь heapq), затем доля
+    COLD_SAMPLE_SHARE - маршрутам, чьи стаканы дольше всех не обновлялись.
+    """
+    budget = int(RATE_LIMIT_BUCKETS["public"]["rate"] * SCAN_INTERVAL * SCAN_BUDGET_SHARE
+                 / ENDPOINT_WEIGHTS["fetch_order_book"][1])
+    hot_budget = budget - int(budget * COLD_SAMPLE_SHARE)
+    now = time.time()
+    
+    routes = {}
+    for triangle in triangles:
+        route = get_route(triangle, markets)
+        if route is not None:
+            routes[triangle] = route
+    heap = [(-triangle_priority(triangle, route), triangle) for triangle, route in routes.items()]
+    heapq.heapify(heap)
+    
+    selected = {}  # symbol -> None, порядок - порядок загрузки
+    def take(triangle, limit):
+        legs = [symbol for symbol in routes[triangle]["symbols"] if symbol not in selected]
+        if len(selected) + len(legs) > limit:
+            return False
+        selected.update(dict.fromkeys(legs))
+        TRIANGLE_SCHEDULED[triangle] = now
+        return True
+    
+    hot_routes = []
+    while heap and len(selected) < hot_budget:
+        _, triangle = heapq.heappop(heap)
+        if take(triangle, hot_budget):
+            hot_routes.append(triangle)
+    hot_books = len(selected)
+    
+    cold_routes = 0
+    for _, triangle in sorted(heap, key=lambda item: TRIANGLE_SCHEDULED.get(item[1], 0)):
+        if len(selected) >= budget:
+            break
+        cold_routes += take(triangle, budget)
+    
+    SCHEDULER_STATS.update({
+        "budget": budget,
+        "hot_books": hot_books,
+        "cold_books": len(selected) - hot_books,
+        "skipped_books": len(book_symbols) - len(selected),
+        "hot_routes": len(hot_routes),
+        "cold_routes": cold_routes,
+        "top": [format_route(triangle) for triangle in hot_routes[:3]]
+    })
+    inc_counter("scheduled_books_total", hot_books, kind="hot")
+    inc_counter("scheduled_books_total", len(selected) - hot_books, kind="cold")
+    return list(selected)
+
+def describe_schedule():
+    """Распределение бюджета стаканов последнего цикла для лога"""
+    if not SCHEDULER_STATS:
+        return "uniform"
+    stats = SCHEDULER_STATS
+    return (
+        f"budget {stats['budget']} books: {stats['hot_books']} hot ({stats['hot_routes']} routes), "
+        f"{stats['cold_books']} cold ({stats['cold_routes']} routes), {stats['skipped_books']} skipped; "
+        f"top {', '.join(stats['top']) or '-'}"
+    )
+
+async def evaluate_updated_triangles(symbol_index, symbols, markets, scorer=None, check=None):
+    """Переоценивает только треугольники, затронутые обновлениями стаканов"""
+    check = check or check_triangle
+    updated = set(UPDATED_SYMBOLS)
+    UPDATED_SYMBOLS.clear()
+    BOOK_UPDATE_EVENT.clear()
+    
+    triangles = {t for symbol in updated for t in symbol_index.get(symbol, ())}
+    touched = len(triangles)
+    
+    if scorer is not None and triangles:
+        # Пакетный отбор кандидатов; скалярная проверка и исполнение - только для них
+        updated_symbols = list(updated)
+        orderbooks = await asyncio.gather(*(get_order_book(s) for s in updated_symbols), return_exceptions=True)
+        for symbol, orderbook in zip(updated_symbols, orderbooks):
+            if isinstance(orderbook, Exception):
+                inc_counter("errors_total", stage="orderbook")
+                await log_debug(f"Orderbook error for {symbol}: {str(orderbook)}")
+                orderbook = None
+                BOOK_FINGERPRINTS.pop(symbol, None)
+            update_book_arrays(scorer, symbol, orderbook)
+        
+        start_amounts = {}
+        for base in {t[0] for t in triangles}:
+            # При подборе объема отбираем по малому объему: прибыль вогнута по размеру сделки,
+            # поэтому цикл, выгодный хоть при каком-то объеме, выгоден и при минимальном
+            probe_volume = MIN_TRADE_VOLUME_USDT if SIZING_MODE == "optimal" else None
+            start_amounts[base] = await get_start_amount(base, probe_volume)
+        
+        triangles = list(triangles)
+        profits = {} if SCAN_SCHEDULER == "adaptive" else None
+        started = time.perf_counter()
+        candidates = score_triangles_batch(scorer, triangles, start_amounts, profits)
+        observe("batch_scoring_ms", (time.perf_counter() - started) * 1000)
+        if profits:
+            # Кандидатов учтет price_triangle по точной оценке
+            candidate_set = {t for _, t in candidates}
+            for triangle, profit_percent in profits.items():
+                if triangle not in candidate_set:
+                    record_triangle_profit(triangle, profit_percent)
+        
+        if VERIFY_BATCH_SCORING:
+            leg_books = {}
+            for symbol in {s for t in triangles for s in get_route(t, markets)["symbols"]}:
+                leg_books[symbol] = await get_order_book(symbol)
+            diff = verify_batch_scoring(scorer, triangles, markets, leg_books, start_amounts)
+            if diff > 1e-9:
+                await log_debug(f"Batch scoring mismatch: max profit diff {diff}")
+        
+        triangles = [t for _, t in candidates]
+    
+    results = await asyncio.gather(
+        *(check(triangle, symbols, markets) for triangle in triangles),
+        return_exceptions=True
+    )
+    for error in results:
+        if isinstance(error, Exception):
+            inc_counter("errors_total", stage="triangle")
+            await log_debug(f"Triangle error: {str(error)}")
+    return len(updated), touched
+
+def record_markets(markets, symbols):
+    """Запоминает метаданные рынков: они пишутся заголовком в каждый сегмент записи.
+    
+    Следующая запись открывает новый сегмент, чтобы обновленный заголовок попал в файл.
+    """
+    RECORD_SEGMENT["path"] = None
+    RECORD_SEGMENT["header"] = {
+        "type": "markets",
+        "markets": {
+            symbol: {key: markets[symbol].get(key) for key in ("base", "quote", "active", "spot", "taker", "limits", "precision")}
+            for symbol in symbols if symbol in markets
+        }
+    }
+
+def record_book_message(message):
+    """Добавляет сообщение стакана в буфер записи с локальным временем получения"""
+    # Уровни копируются: ccxt.pro отдает один и тот же изменяемый стакан, а запись идет позже в потоке
+    RECORD_BUFFER.append(dict(
+        message,
+        bids=[list(level[:2]) for level in message["bids"]],
+        asks=[list(level[:2]) for level in message["asks"]],
+        recv_ts=time.time()
+    ))
+
+def write_book_records(records):
+    """Дописывает сообщения в сжатый JSONL-сегмент, ротируя сегменты по времени"""
+    os.makedirs(RECORD_BOOKS_DIR, exist_ok=True)
+    now = time.time()
+    lines = []
+    if RECORD_SEGMENT["path"] is None or now - RECORD_SEGMENT["opened"] >= RECORD_ROTATE_SECONDS:
+        # Микросекунды в имени: после обновления рынков новый сегмент может открыться в ту же секунду
+        name = f"books-{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}.jsonl.gz"
+        RECORD_SEGMENT.update(path=os.path.join(RECORD_BOOKS_DIR, name), opened=now)
+        if RECORD_SEGMENT["header"]:
+            lines.append(json.dumps(RECORD_SEGMENT["header"], separators=(",", ":")))
+    
+    lines += [json.dumps(record, separators=(",", ":")) for record in records]
+    with gzip.open(RECORD_SEGMENT["path"], "at") as f:
+        f.write("\n".join(lines) + "\n")
+
+async def run_book_recorder():
+    """Фоновый сброс записанных стаканов на диск"""
+    while True:
+        await asyncio.sleep(1)
+        if not RECORD_BUFFER:
+            continue
+        records = RECORD_BUFFER[:]
+        del RECORD_BUFFER[:len(records)]
+        try:
+            await asyncio.to_thread(write_book_records, records)
+        except Exception as e:
+            print(f"Book recorder error: {str(e)}")
+
+async def send_telegram_message(text):
+    if not TELEGRAM_ENABLED:
+        return
+    
+    # Отправку выполняет run_telegram_notifier, торговые сообщения идут вне очереди отладки
+    ALERT_QUEUE.put_nowait(text)
+    NOTIFY_EVENT.set()
+
+def format_route(triangle):
+    """Форматирует цикл как BASE->MID1->...->BASE"""
+    return "->".join(triangle + (triangle[0],))
+
+def log_trade(triangle, profit, volume, status, details=""):
+    """Добавляет запись в буфер журнала; на диск ее пишет run_journal_writer"""
+    JOURNAL_BUFFER.append({
+        "timestamp": datetime.utcnow().isoformat(),
+        "network": NETWORK_NAME,
+        "route": format_route(triangle),
+        "profit_percent": round(float(profit), 4),
+        "volume_usdt": float(volume),
+        "status": status,
+        "details": str(details)
+    })
+    if len(JOURNAL_BUFFER) >= JOURNAL_FLUSH_SIZE:
+        JOURNAL_FLUSH_EVENT.set()
+
+def write_journal_records(records):
+    """Дописывает записи в текущий сегмент журнала (длина + JSON), ротируя сегменты по размеру"""
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    path = JOURNAL_SEGMENT["path"]
+    if path is None or not os.path.exists(path) or os.path.getsize(path) >= JOURNAL_ROTATE_BYTES:
+        path = os.path.join(JOURNAL_DIR, f"trades-{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}.jrnl")
+        JOURNAL_SEGMENT["path"] = path
+    
+    chunks = []
+    for record in records:
+        payload = json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode()
+        chunks.append(struct.pack("<I", len(payload)))
+        chunks.append(payload)
+    with open(path, "ab") as f:
+        f.write(b"".join(chunks))
+
+async def flush_journal():
+    """Сбрасывает буфер журнала на диск вне event loop"""
+    if not JOURNAL_BUFFER:
+        return
+    records = JOURNAL_BUFFER[:]
+    del JOURNAL_BUFFER[:len(records)]
+    try:
+        async with JOURNAL_LOCK:
+            await asyncio.to_thread(write_journal_records, records)
     except Exception as e:
         print(f"Log error: {str(e)}")
 
+async def run_journal_writer():
+    """Фоновый сброс журнала по размеру буфера или по времени"""
+    while True:
+        try:
+            await asyncio.wait_for(JOURNAL_FLUSH_EVENT.wait(), timeout=JOURNAL_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        JOURNAL_FLUSH_EVENT.clear()
+        await flush_journal()
+
+def read_journal(path=None):
+    """Читает записи журнала из сегмента или всех сегментов каталога по порядку"""
+    path = path or JOURNAL_DIR
+    if not os.path.exists(path):
+        return  # Журнал еще ни разу не сбрасывался на диск
+    paths = sorted(glob.glob(os.path.join(path, "*.jrnl"))) if os.path.isdir(path) else [path]
+    for segment in paths:
+        with open(segment, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + 4 <= len(data):
+            (length,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            if offset + length > len(data):
+                break  # Недописанная последняя запись
+            yield json.loads(data[offset:offset + length])
+            offset += length
+
+def export_journal_csv(output, path=None):
+    """Выгружает журнал в CSV с корректным экранированием полей"""
+    import csv
+    
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=JOURNAL_FIELDS)
+        writer.writeheader()
+        for record in read_journal(path):
+            writer.writerow(record)
+
 async def fetch_balances():
     try:
         await log_debug("Fetching balances...")
-        balances = await exchange.fetch_balance()
+        balances = await call_exchange("fetch_balance")
         return {k: float(v) for k, v in balances["total"].items() if float(v) > 0.000001}
     except Exception as e:
         await log_debug(f"Balance error: {str(e)}")
         return {}
 
-async def execute_real_trade(route_id, steps):
-    """Выполняет торговые операции с защитой"""
-    # Проверка лимитов
-    limit_ok, period = await check_rate_limits()
-    if not limit_ok:
-        return False, f"Rate limit exceeded for {period}"
-
-    # Проверка объемов для каждого шага
-    for symbol, _, amount in steps:
-        if not await check_volume_limits(symbol, amount):
-            return False, f"Volume exceeds 1% daily limit for {symbol}"
-    
-    if TESTNET_MODE:
-        # Симуляция для тестовой сети
-        test_msg = [
-            f"🧪 <b>{NETWORK_NAME}: TEST TRADE</b>",
-            f"Route: {route_id}",
-            "Steps:"
-        ]
-        
-        for i, (symbol, side, amount) in enumerate(steps):
-            test_msg.append(f"{i+1}. {symbol} {side.upper()} {amount:.6f}")
+async def seed_account_balances():
+    """Загружает остатки с биржи в локальное хранилище"""
+    balances = await fetch_balances()
+    if balances:
+        ACCOUNT_BALANCES.clear()
+        ACCOUNT_BALANCES.update(balances)
+    return balances
+
+def apply_order_fill(symbol, side, order, requested, price):
+    """Обновляет локальные остатки по исполнению ордера"""
+    base, quote = symbol.split("/")
+    filled = order.get("filled")
+    filled = float(filled) if filled is not None else float(requested)
+    average = float(order.get("average") or price or 0)
+    cost = float(order.get("cost") or filled * average)
+    
+    if side == "buy":
+        ACCOUNT_BALANCES[quote] = ACCOUNT_BALANCES.get(quote, 0) - cost
+        ACCOUNT_BALANCES[base] = ACCOUNT_BALANCES.get(base, 0) + filled
+        received = base
+    else:
+        ACCOUNT_BALANCES[base] = ACCOUNT_BALANCES.get(base, 0) - filled
+        ACCOUNT_BALANCES[quote] = ACCOUNT_BALANCES.get(quote, 0) + cost
+        received = quote
+    
+    fee = order.get("fee") or {}
+    if fee.get("cost") is not None and fee.get("currency"):
+        ACCOUNT_BALANCES[fee["currency"]] = ACCOUNT_BALANCES.get(fee["currency"], 0) - float(fee["cost"])
+    else:
+        ACCOUNT_BALANCES[received] -= (filled if side == "buy" else cost) * market_fee(symbol)
+
+def observe_slippage(side, order, price):
+    """Записывает проскальзывание исполнения относительно оценки по стакану, б.п."""
+    average = order.get("average")
+    if not average or not price:
+        return
+    slippage = (float(average) / price - 1) * 10000
+    observe("slippage_bps", slippage if side == "buy" else -slippage, SLIPPAGE_BUCKETS)
+
+async def reconcile_balances_loop():
+    """Периодически сверяет локальные остатки с биржей вне торгового пути"""
+    while True:
+        await asyncio.sleep(BALANCE_RECONCILE_INTERVAL)
+        await seed_account_balances()
+
+async def run_balance_stream():
+    """Обновляет остатки из приватного потока watch_balance (ccxt.pro)"""
+    client = create_stream_client()
+    try:
+        while True:
+            try:
+                balance = await client.watch_balance()
+                ACCOUNT_BALANCES.update({k: float(v) for k, v in balance["total"].items() if v is not None})
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await log_debug(f"Balance stream error: {str(e)}")
+                await asyncio.sleep(5)
+    finally:
+        await client.close()
+
+async def refresh_tickers_loop():
+    """Обновляет кэш тикеров (24ч объемы) одним запросом по расписанию"""
+    while True:
+        try:
+            tickers = await call_exchange("fetch_tickers")
+            TICKER_CACHE.update(tickers)
+        except Exception as e:
+            await log_debug(f"Ticker refresh error: {str(e)}")
+        await asyncio.sleep(TICKER_REFRESH_INTERVAL)
+
+async def execute_real_trade(route_id, steps, prices=None, detected_at=None, opportunity=None):
+    """Выполняет торговые операции с защитой (opportunity - переоценка перед ордерами)"""
+    # Сделки выполняются по одной, чтобы параллельная оценка не обошла лимиты
+    async with EXECUTION_LOCK:
+        # Проверка лимитов
+        limit_ok, period = await check_rate_limits()
+        if not limit_ok:
+            return False, f"Rate limit exceeded for {period}"
+
+        # Проверка объемов для каждого шага
+        for symbol, _, amount in steps:
+            if not await check_volume_limits(symbol, amount):
+                return False, f"Volume exceeds 1% daily limit for {symbol}"
+        
+        # Между обнаружением и ордерами были await (Telegram, лимиты): цены сверяются заново
+        if opportunity is not None and REVALIDATE_BEFORE_TRADE:
+            fresh, revalidated = await revalidate_opportunity(opportunity)
+            if not fresh:
+                return False, revalidated
+            steps, prices = revalidated
+    
+        if TESTNET_MODE:
+            # Симуляция для тестовой сети
+            test_msg = [
+                f"🧪 <b>{NETWORK_NAME}: TEST TRADE</b>",
+                f"Route: {route_id}",
+                f"Mode: {EXECUTION_MODE} / {ORDER_TYPE}",
+                "Steps:"
+            ]
+        
+            for i, (symbol, side, amount) in enumerate(steps):
+                test_msg.append(f"{i+1}. {symbol} {side.upper()} {amount:.6f}")
             
-        test_msg.append("\n⚠️ <i>No real execution in test mode</i>")
-        await send_telegram_message("\n".join(test_msg))
+            test_msg.append("\n⚠️ <i>No real execution in test mode</i>")
+            await send_telegram_message("\n".join(test_msg))
         
-        # Обновляем счетчики даже в тестовом режиме
-        for period in ["minute", "hour", "day"]:
-            TRADE_COUNTER[period]["count"] += 1
+            # Обновляем счетчики даже в тестовом режиме
+            for period in ["minute", "hour", "day"]:
+                TRADE_COUNTER[period]["count"] += 1
             
-        return True, "Test trade simulated"
+            return True, "Test trade simulated"
     
-    try:
-        # Реальная сделка
-        results = []
-        for i, (symbol, side, amount) in enumerate(steps):
-            market = exchange.market(symbol)
-            min_amount = float(market['limits']['amount']['min'])
+        if EXECUTION_MODE == "parallel" and prices:
+            if detected_at is not None:
+                observe("detection_to_order_ms", (time.time() - detected_at) * 1000)
+            success, results = await execute_parallel_legs(route_id, steps, prices)
+            if success:
+                for period in ["minute", "hour", "day"]:
+                    TRADE_COUNTER[period]["count"] += 1
+            return success, results
+        
+        if ORDER_TYPE == "limit_ioc":
+            # Лимитные IOC ордера требуют цен снапшота, как и параллельный режим
+            if not prices:
+                return False, "limit_ioc requires snapshot prices"
+            success, results = await execute_sequential_legs(route_id, steps, prices, detected_at)
+            if success:
+                for period in ["minute", "hour", "day"]:
+                    TRADE_COUNTER[period]["count"] += 1
+            return success, results
+    
+        try:
+            # Реальная сделка
+            results = []
+            for i, (symbol, side, amount) in enumerate(steps):
+                min_amount = MARKET_RULES[symbol]["min_amount"] if symbol in MARKET_RULES \
+                    else float(exchange.market(symbol)['limits']['amount']['min'])
             
-            if amount < min_amount:
-                return False, f"Amount below min: {amount} < {min_amount} for {symbol}"
+                if amount < min_amount:
+                    return False, f"Amount below min: {amount} < {min_amount} for {symbol}"
             
-            formatted_amount = float(exchange.amount_to_precision(symbol, amount))
-            await log_debug(f"Creating {side} order for {symbol}: {formatted_amount}")
-            order = await exchange.create_order(
-                symbol=symbol,
-                type='market',
-                side=side,
-                amount=formatted_amount
-            )
-            results.append(order)
-            await log_debug(f"Order executed: {order['id']}")
+                formatted_amount = float(exchange.amount_to_precision(symbol, amount))
+                await log_debug(f"Creating {side} order for {symbol}: {formatted_amount}")
+                started = time.perf_counter()
+                if i == 0 and detected_at is not None:
+                    observe("detection_to_order_ms", (time.time() - detected_at) * 1000)
+                order = await call_exchange(
+                    "create_order",
+                    symbol=symbol,
+                    type='market',
+                    side=side,
+                    amount=formatted_amount
+                )
+                observe("order_roundtrip_ms", (time.perf_counter() - started) * 1000)
+                results.append(order)
+                price = prices[i] if prices else None
+                requested = formatted_amount / price if side == "buy" and price else formatted_amount
+                apply_order_fill(symbol, side, order, requested, price)
+                observe_slippage(side, order, price)
+                await log_debug(f"Order executed: {order['id']}")
             
-            # Пауза между шагами
-            if i < len(steps) - 1:
-                await asyncio.sleep(1)
+                # Пауза между шагами
+                if i < len(steps) - 1:
+                    await asyncio.sleep(1)
         
-        # Обновляем счетчики после успешной сделки
-        for period in ["minute", "hour", "day"]:
-            TRADE_COUNTER[period]["count"] += 1
+            # Обновляем счетчики после успешной сделки
+            for period in ["minute", "hour", "day"]:
+                TRADE_COUNTER[period]["count"] += 1
             
-        return True, results
-    except Exception as e:
-        await log_debug(f"Trade execution failed: {str(e)}")
-        return False, str(e)
+            return True, results
+        except Exception as e:
+            inc_counter("errors_total", stage="execution")
+            await log_debug(f"Trade execution failed: {str(e)}")
+            return False, str(e)
 
-async def check_triangle(base, mid1, mid2, symbols, markets):
+async def place_leg_order(symbol, side, amount, price):
+    """Отправляет ордер одного шага по цене снапшота и замеряет задержку"""
+    base_amount = amount / price if side == "buy" else amount
+    leg = {"symbol": symbol, "side": side, "price": price, "requested": 0.0, "filled": 0.0, "average": None}
     try:
-        s1 = f"{mid1}/{base}" if f"{mid1}/{base}" in symbols else f"{base}/{mid1}"
-        s2 = f"{mid2}/{mid1}" if f"{mid2}/{mid1}" in symbols else f"{mid1}/{mid2}"
-        s3 = f"{mid2}/{base}" if f"{mid2}/{base}" in symbols else f"{base}/{mid2}"
+        min_amount = MARKET_RULES[symbol]["min_amount"] if symbol in MARKET_RULES \
+            else float(exchange.market(symbol)['limits']['amount']['min'] or 0)
+        leg["requested"] = float(exchange.amount_to_precision(symbol, base_amount))
+        if leg["requested"] < min_amount:
+            leg["error"] = f"Amount below min: {leg['requested']} < {min_amount}"
+            return leg
+        
+        order_args = {"symbol": symbol, "type": "market", "side": side, "amount": leg["requested"]}
+        if ORDER_TYPE == "limit_ioc":
+            limit_price = price * (1 + LIMIT_IOC_SLIPPAGE if side == "buy" else 1 - LIMIT_IOC_SLIPPAGE)
+            order_args.update(
+                type="limit",
+                price=float(exchange.price_to_precision(symbol, limit_price)),
+                params={"timeInForce": "IOC"}
+            )
+        
+        started = time.perf_counter()
+        order = await call_exchange("create_order", **order_args)
+        leg["latency_ms"] = (time.perf_counter() - started) * 1000
+        observe("order_roundtrip_ms", leg["latency_ms"])
+        leg["order"] = order
+        # Биржа может вернуть ордер до исполнения: без данных считаем рыночный ордер исполненным полностью
+        filled = order.get("filled")
+        leg["filled"] = float(filled) if filled is not None else (leg["requested"] if ORDER_TYPE == "market" else 0.0)
+        leg["average"] = float(order.get("average") or price)
+        apply_order_fill(symbol, side, order, leg["filled"], price)
+        observe_slippage(side, order, price)
+    except Exception as e:
+        inc_counter("errors_total", stage="execution")
+        leg["error"] = str(e)
+    return leg
 
-        # Проверка существования пар
-        if s1 not in markets or s2 not in markets or s3 not in markets:
-            return
+def reconcile_fills(legs, route_base):
+    """Сверяет исполнение шагов и копит перекос запасов по валютам для ребалансировки"""
+    partial = []
+    for leg in legs:
+        base, quote = leg["symbol"].split("/")
+        average = leg["average"] or leg["price"]
+        fee = market_fee(leg["symbol"])
+        if leg["side"] == "buy":
+            flows = {quote: -leg["filled"] * average, base: leg["filled"] * (1 - fee)}
+        else:
+            flows = {base: -leg["filled"], quote: leg["filled"] * average * (1 - fee)}
+        for currency, amount in flows.items():
+            if currency != route_base:
+                INVENTORY_DRIFT[currency] = INVENTORY_DRIFT.get(currency, 0) + amount
+        
+        if leg["filled"] < leg["requested"]:
+            partial.append(f"{leg['symbol']} {leg['filled']}/{leg['requested']}")
+    return partial
 
-        # Шаг 1
-        side1 = "buy" if f"{mid1}/{base}" in symbols else "sell"
-        price1, vol1, liq1 = await get_execution_price(s1, side1, TARGET_VOLUME_USDT)
-        if price1 is None:
-            await log_debug(f"Price1 not available for {s1}")
-            return
-            
-        step1 = (1 / price1 if f"{mid1}/{base}" in symbols else price1) * (1 - COMMISSION_RATE)
-        amount_after_step1 = TARGET_VOLUME_USDT / price1 if side1 == "buy" else TARGET_VOLUME_USDT * price1
-        amount_after_step1 *= (1 - COMMISSION_RATE)
-
-        # Шаг 2
-        side2 = "buy" if f"{mid2}/{mid1}" in symbols else "sell"
-        price2, vol2, liq2 = await get_execution_price(s2, side2, amount_after_step1)
-        if price2 is None:
-            await log_debug(f"Price2 not available for {s2}")
-            return
-            
-        step2 = (1 / price2 if f"{mid2}/{mid1}" in symbols else price2) * (1 - COMMISSION_RATE)
-        amount_after_step2 = amount_after_step1 / price2 if side2 == "buy" else amount_after_step1 * price2
-        amount_after_step2 *= (1 - COMMISSION_RATE)
-
-        # Шаг 3
-        side3 = "sell" if f"{mid2}/{base}" in symbols else "buy"
-        price3, vol3, liq3 = await get_execution_price(s3, side3, amount_after_step2)
-        if price3 is None:
-            await log_debug(f"Price3 not available for {s3}")
-            return
+async def rebalance_inventory(route_base):
+    """Возвращает запасы промежуточных валют к исходным рыночными ордерами к стартовой валюте"""
+    async with REBALANCE_LOCK:
+        for currency, drift in list(INVENTORY_DRIFT.items()):
+            symbol = f"{currency}/{route_base}"
+            try:
+                if symbol not in exchange.markets:
+                    continue
+                orderbook = await get_order_book(symbol)
+                if orderbook is None or not orderbook['bids']:
+                    continue
+                value = abs(drift) * float(orderbook['bids'][0][0])
+                if route_base == "USDT" and value < REBALANCE_MIN_USDT:
+                    continue
             
-        step3 = (price3 if f"{mid2}/{base}" in symbols else 1 / price3) * (1 - COMMISSION_RATE)
+                side = "sell" if drift > 0 else "buy"
+                amount = float(exchange.amount_to_precision(symbol, abs(drift)))
+                if not amount:
+                    continue
+                await log_debug(f"Rebalancing {currency}: {side} {amount} on {symbol}")
+                await call_exchange("create_order", symbol=symbol, type="market", side=side, amount=amount)
+                INVENTORY_DRIFT[currency] = drift - amount if drift > 0 else drift + amount
+            except Exception as e:
+                await log_debug(f"Rebalance error for {currency}: {str(e)}")
+
+async def execute_parallel_legs(route_id, steps, prices):
+    """Отправляет все шаги одновременно из заранее размещенных запасов каждой валюты"""
+    route_base = route_id.split("->")[0]
+    
+    # Каждый шаг тратит свою валюту, поэтому запаса должно хватать на все шаги сразу
+    for symbol, side, amount in steps:
+        base, quote = symbol.split("/")
+        currency = quote if side == "buy" else base
+        available = ACCOUNT_BALANCES.get(currency, 0)
+        if available < amount:
+            return False, f"Insufficient {currency} inventory for parallel execution: {available} < {amount}"
+    
+    legs = await asyncio.gather(*(
+        place_leg_order(symbol, side, amount, price)
+        for (symbol, side, amount), price in zip(steps, prices)
+    ))
+    
+    latencies = ", ".join(f"{leg['symbol']} {leg.get('latency_ms', 0):.0f}ms" for leg in legs)
+    await log_debug(f"Parallel legs sent for {route_id}: {latencies}")
+    
+    partial = reconcile_fills(legs, route_base)
+    errors = [f"{leg['symbol']}: {leg['error']}" for leg in legs if leg.get("error")]
+    if partial or errors:
+        await send_telegram_message(
+            f"⚠️ <b>Partial execution</b>\nRoute: {route_id}\n" + "\n".join(partial + errors)
+        )
+    
+    # Ребалансировка запасов идет в фоне и не задерживает следующий цикл
+    task = asyncio.create_task(rebalance_inventory(route_base))
+    REBALANCE_TASKS.add(task)
+    task.add_done_callback(REBALANCE_TASKS.discard)
+    
+    if all(leg.get("error") for leg in legs):
+        return False, "; ".join(errors)
+    return True, legs
+
+async def execute_sequential_legs(route_id, steps, prices, detected_at=None):
+    """Отправляет шаги по очереди ордерами place_leg_order; неполное исполнение шага останавливает цикл"""
+    route_base = route_id.split("->")[0]
+    legs = []
+    for i, ((symbol, side, amount), price) in enumerate(zip(steps, prices)):
+        if i == 0 and detected_at is not None:
+            observe("detection_to_order_ms", (time.time() - detected_at) * 1000)
+        leg = await place_leg_order(symbol, side, amount, price)
+        legs.append(leg)
+        await log_debug(f"Leg {symbol} {side}: {leg['filled']}/{leg['requested']}")
+        if leg.get("error") or leg["filled"] < leg["requested"]:
+            break
+        
+        # Пауза между шагами
+        if i < len(steps) - 1:
+            await asyncio.sleep(1)
+    
+    partial = reconcile_fills(legs, route_base)
+    errors = [f"{leg['symbol']}: {leg['error']}" for leg in legs if leg.get("error")]
+    if not partial and not errors:
+        return True, legs
+    
+    # Шаги после неисполненного не отправлялись: остатки промежуточных валют возвращаются ребалансировкой
+    skipped = [f"{symbol} skipped" for symbol, _, _ in steps[len(legs):]]
+    await send_telegram_message(
+        f"⚠️ <b>Partial execution</b>\nRoute: {route_id}\n" + "\n".join(partial + errors + skipped)
+    )
+    task = asyncio.create_task(rebalance_inventory(route_base))
+    REBALANCE_TASKS.add(task)
+    task.add_done_callback(REBALANCE_TASKS.discard)
+    return False, "; ".join(errors + partial + skipped)
+
+def triangle_legs(triangle, symbols):
+    """Возвращает шаги цикла: (торговая пара, сторона) для каждого перехода валют"""
+    legs = []
+    for i, currency in enumerate(triangle):
+        target = triangle[(i + 1) % len(triangle)]
+        if f"{target}/{currency}" in symbols:
+            legs.append((f"{target}/{currency}", "buy"))
+        else:
+            legs.append((f"{currency}/{target}", "sell"))
+    return legs
+
+async def load_market_rules(markets):
+    """Собирает правила рынков: комиссия тейкера с учетом VIP-уровня аккаунта, шаг и минимумы объема"""
+    account_fees = {}
+    if not TESTNET_MODE and exchange.apiKey and exchange.has.get("fetchTradingFees"):
+        try:
+            account_fees = await call_exchange("fetch_trading_fees")
+        except Exception as e:
+            await log_debug(f"Trading fees unavailable, using market fees: {str(e)}")
+    build_market_rules(markets, account_fees)
+
+def build_market_rules(markets, account_fees=None):
+    """Заполняет MARKET_RULES по рынкам; account_fees - комиссии аккаунта, приоритетнее комиссий рынка"""
+    account_fees = account_fees or {}
+    MARKET_RULES.clear()
+    for symbol, market in markets.items():
+        MARKET_RULES[symbol] = market_rule(market, (account_fees.get(symbol) or {}).get("taker"))
+    ROUTES.clear()
+
+def market_rule(market, account_fee=None):
+    fee = market.get("taker") if account_fee is None else account_fee
+    limits = market.get('limits') or {}
+    return {
+        "fee": float(fee) if fee is not None else COMMISSION_RATE,
+        "step": amount_step(market),
+        "min_amount": float((limits.get('amount') or {}).get('min') or 0),
+        "min_cost": float((limits.get('cost') or {}).get('min') or 0)
+    }
+
+def market_fee(symbol):
+    rules = MARKET_RULES.get(symbol)
+    return rules["fee"] if rules else COMMISSION_RATE
+
+def get_route(triangle, markets):
+    """Дескриптор маршрута цикла; строится один раз, дальше оценка читает только его списки"""
+    route = ROUTES.get(triangle)
+    if route is None:
+        legs = triangle_legs(triangle, markets)
+        if any(symbol not in markets or not markets[symbol].get('active', True) for symbol, _ in legs):
+            return None
+        rules = [MARKET_RULES.get(symbol) or {"fee": COMMISSION_RATE, "step": 0.0, "min_amount": 0, "min_cost": 0}
+                 for symbol, _ in legs]
+        route = ROUTES[triangle] = {
+            "route_id": format_route(triangle),
+            "legs": legs,
+            "symbols": [symbol for symbol, _ in legs],
+            "is_buy": [side == "buy" for _, side in legs],
+            "fees": [rule["fee"] for rule in rules],
+            "steps": [rule["step"] for rule in rules],
+            "min_amounts": [rule["min_amount"] for rule in rules],
+            "min_costs": [rule["min_cost"] for rule in rules]
+        }
+    return route
+
+async def get_start_amount(base, volume_usdt=None):
+    """Переводит объем в USDT (по умолчанию TARGET_VOLUME_USDT) в единицы стартовой валюты"""
+    volume_usdt = volume_usdt or TARGET_VOLUME_USDT
+    if base == "USDT":
+        return volume_usdt
+    
+    price, _, _ = await get_execution_price(f"{base}/USDT", "buy", volume_usdt)
+    if price is None:
+        return None
+    return volume_usdt / price
+
+def score_triangle(legs, books, start_amount, fees=None):
+    """Скалярная оценка цикла по стаканам: (result, prices, liquidity, steps) или None"""
+    result = 1.0
+    amount = start_amount
+    prices = []
+    liquidity = []
+    steps = []
+    
+    # Проходим шаги цикла, пересчитывая объем после каждого обмена
+    for i, (symbol, side) in enumerate(legs):
+        fee = fees[i] if fees else COMMISSION_RATE
+        orderbook = books.get(symbol)
+        if orderbook is None:
+            return None
+        
+        price, vol, liq = get_avg_price(orderbook['asks' if side == "buy" else 'bids'], amount)
+        if price is None:
+            return None
+        
+        steps.append((symbol, side, amount))
+        prices.append(price)
+        liquidity.append(liq)
+        result *= (1 / price if side == "buy" else price) * (1 - fee)
+        amount = amount / price if side == "buy" else amount * price
+        amount *= (1 - fee)
+    
+    return result, prices, liquidity, steps
+
+def init_batch_scorer(triangles, markets, book_symbols):
+    """Готовит массивы уровней стаканов и шагов треугольников для пакетной оценки"""
+    depth = STREAM_DEPTH_LIMIT if MARKET_DATA_MODE == "stream" else ORDERBOOK_DEPTH
+    rows = {symbol: i for i, symbol in enumerate(book_symbols)}
+    
+    # Ось 0: 0 - asks (покупка), 1 - bids (продажа)
+    shape = (2, len(book_symbols), depth)
+    scorer = {
+        "depth": depth,
+        "rows": rows,
+        "triangle_rows": {},
+        "loaded": np.zeros(len(book_symbols), dtype=bool),
+        "price": np.ones(shape),
+        "cum_quote": np.zeros(shape),
+        "cum_base": np.zeros(shape)
+    }
+    add_scorer_triangles(scorer, triangles, markets)
+    return scorer
+
+def add_scorer_triangles(scorer, triangles, markets):
+    """Добавляет шаги треугольников (строки стаканов, стороны, комиссии) в пакетный оценщик"""
+    for triangle in triangles:
+        route = get_route(triangle, markets)
+        if route is not None:
+            scorer["triangle_rows"][triangle] = (
+                [scorer["rows"].get(symbol, -1) for symbol in route["symbols"]], route["is_buy"], route["fees"]
+            )
+
+def add_scorer_rows(scorer, symbols):
+    """Дописывает строки стаканов в массивы оценщика без пересборки существующих"""
+    new = [symbol for symbol in symbols if symbol not in scorer["rows"]]
+    if not new:
+        return
+    offset = len(scorer["loaded"])
+    for i, symbol in enumerate(new):
+        scorer["rows"][symbol] = offset + i
+    
+    shape = (2, len(new), scorer["depth"])
+    scorer["price"] = np.concatenate((scorer["price"], np.ones(shape)), axis=1)
+    scorer["cum_quote"] = np.concatenate((scorer["cum_quote"], np.zeros(shape)), axis=1)
+    scorer["cum_base"] = np.concatenate((scorer["cum_base"], np.zeros(shape)), axis=1)
+    scorer["loaded"] = np.concatenate((scorer["loaded"], np.zeros(len(new), dtype=bool)))
+
+def update_book_arrays(scorer, symbol, orderbook):
+    """Записывает уровни стакана в строку массивов (кумулятивные суммы по уровням)"""
+    row = scorer["rows"].get(symbol)
+    if row is None:
+        return
+    if orderbook is None:
+        scorer["loaded"][row] = False
+        return
+    
+    depth = scorer["depth"]
+    for side, key in ((0, "asks"), (1, "bids")):
+        price = np.ones(depth)
+        volume = np.zeros(depth)
+        level_prices, level_sizes = book_levels(orderbook[key], depth)
+        price[:len(level_prices)] = level_prices
+        volume[:len(level_sizes)] = level_sizes
+        
+        scorer["price"][side, row] = price
+        scorer["cum_quote"][side, row] = np.cumsum(price * volume)
+        scorer["cum_base"][side, row] = np.cumsum(volume)
+    scorer["loaded"][row] = True
+
+def batch_fill_price(scorer, rows, is_buy, target):
+    """Средняя цена исполнения target (в котируемой валюте) для каждой строки; NaN - не хватает глубины"""
+    side = np.where(is_buy, 0, 1)
+    price = scorer["price"][side, rows]
+    cum_quote = scorer["cum_quote"][side, rows]
+    cum_base = scorer["cum_base"][side, rows]
+    depth = scorer["depth"]
+    
+    # Первый уровень, на котором накопленный объем покрывает target
+    level = (cum_quote < target[:, None]).sum(axis=1)
+    fillable = (level < depth) & (rows >= 0) & scorer["loaded"][rows]
+    level = np.minimum(level, depth - 1)
+    
+    idx = np.arange(len(rows))
+    prev_quote = np.where(level > 0, cum_quote[idx, level - 1], 0.0)
+    prev_base = np.where(level > 0, cum_base[idx, level - 1], 0.0)
+    remaining = target - prev_quote
+    total_base = prev_base + remaining / price[idx, level]
+    total_quote = prev_quote + remaining
+    
+    avg_price = total_quote / total_base
+    return np.where(fillable & (total_quote >= target), avg_price, np.nan)
 
-        result = step1 * step2 * step3
+def score_triangles_batch(scorer, triangles, start_amounts, profits=None):
+    """Оценивает все треугольники одним векторным проходом; возвращает [(profit_percent, triangle)] по убыванию.
+    
+    profits - словарь, куда пишется прибыль всех оцененных треугольников, а не только отобранных.
+    """
+    # Циклы разной длины оцениваются отдельными группами
+    groups = {}
+    for triangle in triangles:
+        groups.setdefault(len(triangle), []).append(triangle)
+    
+    ranked = []
+    for group in groups.values():
+        group = [t for t in group if t in scorer["triangle_rows"]]
+        if not group:
+            continue
+        rows = np.array([scorer["triangle_rows"][t][0] for t in group])
+        is_buy = np.array([scorer["triangle_rows"][t][1] for t in group])
+        fees = np.array([scorer["triangle_rows"][t][2] for t in group])
+        amount = np.array([start_amounts.get(t[0], np.nan) for t in group], dtype=float)
+        result = np.ones(len(group))
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for leg in range(rows.shape[1]):
+                price = batch_fill_price(scorer, rows[:, leg], is_buy[:, leg], amount)
+                result *= np.where(is_buy[:, leg], 1 / price, price) * (1 - fees[:, leg])
+                amount = np.where(is_buy[:, leg], amount / price, amount * price)
+                amount *= (1 - fees[:, leg])
+        
         profit_percent = (result - 1) * 100
+        if profits is not None:
+            profits.update(zip(group, profit_percent.tolist()))
+        selected = np.nonzero((profit_percent >= MIN_PROFIT) & (profit_percent <= MAX_PROFIT))[0]
+        ranked += [(float(profit_percent[i]), group[i]) for i in selected]
+    
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return ranked
+
+def verify_batch_scoring(scorer, triangles, markets, books, start_amounts):
+    """Сравнивает пакетную оценку со скалярной; возвращает максимальное расхождение прибыли, %"""
+    batch = {t: p for p, t in score_triangles_batch(scorer, triangles, start_amounts)}
+    max_diff = 0.0
+    for triangle in triangles:
+        route = get_route(triangle, markets)
+        if route is None:
+            continue
+        scored = score_triangle(route["legs"], books, start_amounts.get(triangle[0]), route["fees"])
+        scalar = None if scored is None else (scored[0] - 1) * 100
+        if scalar is not None and not (MIN_PROFIT <= scalar <= MAX_PROFIT):
+            scalar = None
+        if (scalar is None) != (triangle not in batch):
+            return float("inf")
+        if scalar is not None:
+            max_diff = max(max_diff, abs(scalar - batch[triangle]))
+    return max_diff
+
+def build_fill_curve(orderbook, side, fee):
+    """Кусочно-линейная кривая исполнения шага: объем на входе -> объем на выходе (после комиссии)"""
+    levels = orderbook['asks' if side == "buy" else 'bids']
+    if not len(levels):
+        return None
+    
+    price, volume = book_levels(levels)
+    if side == "buy":
+        # Тратим котируемую валюту, получаем базовую
+        inputs, outputs = np.cumsum(price * volume), np.cumsum(volume)
+    else:
+        inputs, outputs = np.cumsum(volume), np.cumsum(price * volume)
+    return np.concatenate(([0.0], inputs)), np.concatenate(([0.0], outputs)) * (1 - fee)
+
+def amount_step(market):
+    """Шаг объема рынка в базовой валюте"""
+    precision = (market.get('precision') or {}).get('amount')
+    if not precision:
+        return 0.0
+    if ensure_exchange().precisionMode == ccxt.DECIMAL_PLACES:
+        return 10 ** -precision
+    return float(precision)
+
+def simulate_cycle(route, curves, sizes):
+    """Проводит объемы sizes через все шаги с учетом шага объема и минимальных лимитов рынков"""
+    amount = np.asarray(sizes, dtype=float)
+    valid = np.isfinite(amount) & (amount > 0)
+    leg_inputs = []
+    leg_prices = []
+    
+    for leg, (xs, ys) in enumerate(curves):
+        fee, step = route["fees"][leg], route["steps"][leg]
+        min_amount, min_cost = route["min_amounts"][leg], route["min_costs"][leg]
         
-        await log_debug(f"Triangle {base}-{mid1}-{mid2}: Profit={profit_percent:.2f}%")
+        if not route["is_buy"][leg]:
+            if step:
+                amount = np.floor(amount / step) * step
+            base_amount = amount
+            output = np.interp(amount, xs, ys, right=np.nan)
+            cost = output / (1 - fee)
+        else:
+            gross = np.interp(amount, xs, ys, right=np.nan) / (1 - fee)
+            base_amount = np.floor(gross / step) * step if step else gross
+            output = base_amount * (1 - fee)
+            cost = amount
         
-        if not (MIN_PROFIT <= profit_percent <= MAX_PROFIT): 
+        with np.errstate(divide="ignore", invalid="ignore"):
+            leg_prices.append(cost / base_amount)
+        valid &= np.isfinite(output) & (base_amount >= min_amount) & (cost >= min_cost)
+        leg_inputs.append(amount)
+        amount = output
+    
+    return amount, valid, leg_inputs, leg_prices
+
+def optimal_trade_size(route, books, unit_value_usdt):
+    """Подбирает объем на входе цикла, максимизирующий абсолютную прибыль в USDT"""
+    legs = route["legs"]
+    curves = []
+    for (symbol, side), fee in zip(legs, route["fees"]):
+        curve = build_fill_curve(books[symbol], side, fee)
+        if curve is None:
+            return None
+        curves.append(curve)
+    
+    # Выход цикла - вогнутая кусочно-линейная функция входа, максимум прибыли лежит в точке излома.
+    # Переносим изломы каждого шага на ось входа первого шага через обратные кривые предыдущих шагов.
+    candidates = [curves[0][0]]
+    for i, (xs, _) in enumerate(curves[1:], start=1):
+        points = xs
+        for prev_xs, prev_ys in reversed(curves[:i]):
+            points = np.interp(points, prev_ys, prev_xs, right=np.nan)
+        candidates.append(points)
+    
+    min_size = MIN_TRADE_VOLUME_USDT / unit_value_usdt
+    max_size = MAX_TRADE_VOLUME_USDT / unit_value_usdt
+    sizes = np.concatenate(candidates + [[min_size, max_size]])
+    sizes = np.unique(sizes[np.isfinite(sizes) & (sizes >= min_size) & (sizes <= max_size)])
+    if not len(sizes):
+        return None
+    
+    output, valid, leg_inputs, leg_prices = simulate_cycle(route, curves, sizes)
+    profit = np.where(valid, output - sizes, -np.inf)
+    best = int(np.argmax(profit))
+    if not np.isfinite(profit[best]) or profit[best] <= 0:
+        return None
+    
+    size = float(sizes[best])
+    return {
+        "size": size,
+        "size_usdt": size * unit_value_usdt,
+        "profit_usdt": float(profit[best]) * unit_value_usdt,
+        "profit_percent": float(profit[best]) / size * 100,
+        "prices": [float(p[best]) for p in leg_prices],
+        "steps": [(symbol, side, float(a[best])) for (symbol, side), a in zip(legs, leg_inputs)],
+        "curve": [(float(x) * unit_value_usdt, float(p) * unit_value_usdt) for x, p in zip(sizes[valid], profit[valid])]
+    }
+
+async def price_triangle(triangle, symbols, markets):
+    """Оценивает цикл по текущим стаканам и возвращает возможность в пределах MIN/MAX_PROFIT"""
+    base = triangle[0]
+    route = get_route(triangle, markets)
+
+    # Проверка существования пар
+    if route is None:
+        return
+    legs = route["legs"]
+
+    start_amount = await get_start_amount(base)
+    if start_amount is None:
+        await log_debug(f"Start amount not available for {base}")
+        return
+
+    # Стаканы всех шагов загружаются параллельно
+    leg_symbols = route["symbols"]
+    orderbooks = await asyncio.gather(*(get_order_book(symbol) for symbol in leg_symbols), return_exceptions=True)
+    books = {}
+    for symbol, orderbook in zip(leg_symbols, orderbooks):
+        if isinstance(orderbook, Exception):
+            inc_counter("errors_total", stage="orderbook")
+            await log_debug(f"Orderbook error for {symbol}: {str(orderbook)}")
             return
+        books[symbol] = orderbook
 
-        route_id = f"{base}->{mid1}->{mid2}->{base}"
-        route_hash = hashlib.md5(route_id.encode()).hexdigest()
-        now = datetime.utcnow()
-        prev_time = TRIANGLE_CACHE.get(route_hash)
+    route_id = route["route_id"]
+    scoring_started = time.time()
+    if SIZING_MODE == "optimal":
+        sizing = optimal_trade_size(route, books, TARGET_VOLUME_USDT / start_amount)
+        observe("triangle_scoring_ms", (time.time() - scoring_started) * 1000)
+        if sizing is None:
+            if SCAN_SCHEDULER == "adaptive":
+                record_triangle_profit(triangle, float("nan"))
+            await log_debug(f"No profitable size for {route_id}")
+            return
         
-        if prev_time and (now - prev_time).total_seconds() < TRIANGLE_HOLD_TIME:
-            execute = False
-        else:
-            TRIANGLE_CACHE[route_hash] = now
-            execute = True
-
-        min_liquidity = round(min(liq1, liq2, liq3), 2)
-        pure_profit_usdt = round((result - 1) * TARGET_VOLUME_USDT, 2)
-
-        message_lines = [
-            f"🔁 <b>{NETWORK_NAME}: Arbitrage Opportunity</b>",
-            f"🔄 Route: {route_id}",
-            f"1. {s1} {side1.upper()} @ {price1:.6f}",
-            f"2. {s2} {side2.upper()} @ {price2:.6f}",
-            f"3. {s3} {side3.upper()} @ {price3:.6f}",
-            "",
-            f"💰 <b>Profit:</b> {pure_profit_usdt:.2f} USDT",
-            f"📈 <b>Spread:</b> {profit_percent:.2f}%",
-            f"💧 <b>Min Liquidity:</b> ${min_liquidity:.2f}",
-            f"⚙️ <b>Ready:</b> {'YES' if execute else 'NO'}"
-        ]
-
-        await send_telegram_message("\n".join(message_lines))
-        log_trade(base, mid1, mid2, profit_percent, min_liquidity, "detected")
-
-        if execute:
-            # Проверка баланса в основной сети
-            base_balance = 0
-            if not TESTNET_MODE:
-                balances = await fetch_balances()
-                base_balance = balances.get(base, 0)
-                
-                if base_balance < TARGET_VOLUME_USDT:
-                    msg = f"⛔ <b>Insufficient funds</b>\n{base} balance: {base_balance:.2f} < {TARGET_VOLUME_USDT}"
-                    await send_telegram_message(msg)
-                    log_trade(base, mid1, mid2, profit_percent, min_liquidity, "failed", "insufficient_balance")
-                    return
-            
-            steps = []
-            
-            # Шаг 1: base -> mid1
-            if f"{mid1}/{base}" in symbols:
-                steps.append((s1, "buy", TARGET_VOLUME_USDT))
-            else:
-                steps.append((s1, "sell", TARGET_VOLUME_USDT))
+        result = 1 + sizing["profit_percent"] / 100
+        prices, steps = sizing["prices"], sizing["steps"]
+        liquidity = [amount for _, _, amount in steps]
+        trade_volume_usdt = sizing["size_usdt"]
+        curve = ", ".join(f"{size:.2f}:{profit:+.4f}" for size, profit in sizing["curve"])
+        await log_debug(f"Profit curve {route_id} (USDT size:profit): {curve}")
+    else:
+        scored = score_triangle(legs, books, start_amount, route["fees"])
+        observe("triangle_scoring_ms", (time.time() - scoring_started) * 1000)
+        if scored is None:
+            if SCAN_SCHEDULER == "adaptive":
+                record_triangle_profit(triangle, float("nan"))
+            await log_debug(f"Prices not available for {route_id}")
+            return
+        
+        result, prices, liquidity, steps = scored
+        trade_volume_usdt = TARGET_VOLUME_USDT
+    
+    profit_percent = (result - 1) * 100
+    if SCAN_SCHEDULER == "adaptive":
+        record_triangle_profit(triangle, profit_percent)
+    
+    await log_debug(f"Triangle {'-'.join(triangle)}: Profit={profit_percent:.2f}%")
+    
+    if not (MIN_PROFIT <= profit_percent <= MAX_PROFIT): 
+        return
+    
+    return {
+        "triangle": triangle,
+        "route_id": route_id,
+        "legs": legs,
+        "prices": prices,
+        "steps": steps,
+        "liquidity": liquidity,
+        "result": result,
+        "profit_percent": profit_percent,
+        "trade_volume_usdt": trade_volume_usdt,
+        "detected_at": scoring_started,
+        "leg_confirmed_at": [book_confirmed_at(symbol) for symbol in leg_symbols],
+        "fees": route["fees"]
+    }
+
+async def revalidate_opportunity(opportunity):
+    """Переоценивает цикл по самым свежим стаканам перед ордерами.
+    
+    Возвращает (True, (steps, prices)) для исполнения или (False, причина), если стаканы
+    устарели или прибыль вышла за границы.
+    """
+    legs = opportunity["legs"]
+    # Недостающие и устаревшие REST-стаканы загружаются заново (у исполнителя при шардировании
+    # своих стаканов нет); потоковые не перезагружаются - их свежесть определяет жизнь потока
+    now = time.time()
+    refetch = []
+    for symbol, _ in legs:
+        if (LOCAL_BOOKS.get(symbol) or {}).get("synced"):
+            continue
+        confirmed_at = book_confirmed_at(symbol)
+        if confirmed_at is None or (now - confirmed_at) * 1000 > MAX_BOOK_AGE_MS:
+            refetch.append(symbol)
+    if refetch:
+        fetched = await asyncio.gather(*(refetch_order_book(symbol) for symbol in refetch), return_exceptions=True)
+        for symbol, orderbook in zip(refetch, fetched):
+            if isinstance(orderbook, Exception):
+                inc_counter("revalidation_total", result="missing")
+                return False, f"No orderbook for {symbol}: {str(orderbook)}"
+    
+    now = time.time()
+    pipeline_ms = (now - opportunity["detected_at"]) * 1000
+    observe("revalidation_delay_ms", pipeline_ms)
+    # Возраст стаканов шагов в момент обнаружения: насколько старые данные дали сигнал
+    for confirmed_at in opportunity.get("leg_confirmed_at") or ():
+        if confirmed_at is not None:
+            observe("leg_age_at_detection_ms", (opportunity["detected_at"] - confirmed_at) * 1000)
+    books = {}
+    for symbol, _ in legs:
+        orderbook, _ = latest_order_book(symbol)
+        age_ms = (now - book_confirmed_at(symbol)) * 1000
+        if age_ms > MAX_BOOK_AGE_MS:
+            inc_counter("revalidation_total", result="stale")
+            return False, f"Stale orderbook for {symbol}: {age_ms:.0f} ms > {MAX_BOOK_AGE_MS:.0f} ms"
+        books[symbol] = orderbook
+    
+    scored = score_triangle(legs, books, opportunity["steps"][0][2], opportunity.get("fees"))
+    if scored is None:
+        inc_counter("revalidation_total", result="missing")
+        return False, "Prices not available on revalidation"
+    
+    result, prices, _, steps = scored
+    profit_percent = (result - 1) * 100
+    observe("edge_decay_bps", (opportunity["profit_percent"] - profit_percent) * 100, SLIPPAGE_BUCKETS)
+    min_profit = MIN_PROFIT if REVALIDATE_MIN_PROFIT is None else REVALIDATE_MIN_PROFIT
+    if not (min_profit <= profit_percent <= MAX_PROFIT):
+        inc_counter("revalidation_total", result="decayed")
+        # Как быстро возможность исчезает после обнаружения
+        observe("decay_time_ms", pipeline_ms)
+        return False, f"Edge decayed: {opportunity['profit_percent']:.3f}% -> {profit_percent:.3f}%"
+    
+    inc_counter("revalidation_total", result="passed")
+    return True, (steps, prices)
+
+async def handle_opportunity(opportunity):
+    """Дедупликация, уведомление и исполнение найденной возможности (только в процессе-исполнителе)"""
+    triangle, route_id = opportunity["triangle"], opportunity["route_id"]
+    legs, prices, steps = opportunity["legs"], opportunity["prices"], opportunity["steps"]
+    result, profit_percent = opportunity["result"], opportunity["profit_percent"]
+    trade_volume_usdt = opportunity["trade_volume_usdt"]
+    base = triangle[0]
+    trade_amount = steps[0][2]
+    
+    route_hash = hashlib.md5(route_id.encode()).hexdigest()
+    now = datetime.utcnow()
+    prev_time = TRIANGLE_CACHE.get(route_hash)
+    
+    if prev_time and (now - prev_time).total_seconds() < TRIANGLE_HOLD_TIME:
+        execute = False
+    else:
+        TRIANGLE_CACHE[route_hash] = now
+        execute = True
+
+    min_liquidity = round(min(opportunity["liquidity"]), 2)
+    pure_profit_usdt = round((result - 1) * trade_volume_usdt, 2)
+
+    message_lines = [
+        f"🔁 <b>{NETWORK_NAME}: Arbitrage Opportunity</b>",
+        f"🔄 Route: {route_id}"
+    ]
+    for i, ((symbol, side), price) in enumerate(zip(legs, prices)):
+        message_lines.append(f"{i + 1}. {symbol} {side.upper()} @ {price:.6f}")
+    message_lines += [
+        "",
+        f"📐 <b>Size:</b> {trade_volume_usdt:.2f} USDT",
+        f"💰 <b>Profit:</b> {pure_profit_usdt:.2f} USDT",
+        f"📈 <b>Spread:</b> {profit_percent:.2f}%",
+        f"💧 <b>Min Liquidity:</b> ${min_liquidity:.2f}",
+        f"⚙️ <b>Ready:</b> {'YES' if execute else 'NO'}"
+    ]
+
+    await send_telegram_message("\n".join(message_lines))
+    log_trade(triangle, profit_percent, min_liquidity, "detected")
+
+    if execute:
+        # Проверка баланса в основной сети
+        base_balance = 0
+        if not TESTNET_MODE:
+            base_balance = ACCOUNT_BALANCES.get(base, 0)
             
-            # Шаг 2: mid1 -> mid2
-            amount_mid1 = TARGET_VOLUME_USDT / price1 * (1 - COMMISSION_RATE) if f"{mid1}/{base}" in symbols else TARGET_VOLUME_USDT * price1 * (1 - COMMISSION_RATE)
-            if f"{mid2}/{mid1}" in symbols:
-                steps.append((s2, "buy", amount_mid1))
-            else:
-                steps.append((s2, "sell", amount_mid1))
+            if base_balance < trade_amount:
+                msg = f"⛔ <b>Insufficient funds</b>\n{base} balance: {base_balance:.2f} < {trade_amount}"
+                await send_telegram_message(msg)
+                log_trade(triangle, profit_percent, min_liquidity, "failed", "insufficient_balance")
+                return
+        
+        # Выполнение сделки
+        trade_success, trade_result = await execute_real_trade(route_id, steps, prices, opportunity["detected_at"], opportunity)
+        
+        if trade_success:
+            status_msg = "simulated" if TESTNET_MODE else "executed"
+            profit_msg = f"Expected profit: {pure_profit_usdt:.2f} USDT"
             
-            # Шаг 3: mid2 -> base
-            amount_mid2 = amount_mid1 / price2 * (1 - COMMISSION_RATE) if f"{mid2}/{mid1}" in symbols else amount_mid1 * price2 * (1 - COMMISSION_RATE)
-            if f"{mid2}/{base}" in symbols:
-                steps.append((s3, "sell", amount_mid2))
-            else:
-                steps.append((s3, "buy", amount_mid2))
+            if not TESTNET_MODE:
+                new_base_balance = ACCOUNT_BALANCES.get(base, 0)
+                profit_usdt = new_base_balance - base_balance
+                profit_msg = f"Actual profit: {profit_usdt:.2f} {base}"
             
-            # Выполнение сделки
-            trade_success, trade_result = await execute_real_trade(route_id, steps)
+            msg = [
+                f"✅ <b>{NETWORK_NAME}: Trade {status_msg}</b>",
+                f"Route: {route_id}",
+                f"Spread: {profit_percent:.2f}%",
+                profit_msg
+            ]
             
-            if trade_success:
-                status_msg = "simulated" if TESTNET_MODE else "executed"
-                profit_msg = f"Expected profit: {pure_profit_usdt:.2f} USDT"
-                
-                if not TESTNET_MODE:
-                    new_balances = await fetch_balances()
-                    new_base_balance = new_balances.get(base, 0)
-                    profit_usdt = new_base_balance - base_balance
-                    profit_msg = f"Actual profit: {profit_usdt:.2f} USDT"
-                
-                msg = [
-                    f"✅ <b>{NETWORK_NAME}: Trade {status_msg}</b>",
-                    f"Route: {route_id}",
-                    f"Spread: {profit_percent:.2f}%",
-                    profit_msg
-                ]
-                
-                await send_telegram_message("\n".join(msg))
-                log_trade(base, mid1, mid2, profit_percent, TARGET_VOLUME_USDT, status_msg)
-            else:
-                msg = f"❌ <b>Trade failed</b>\nRoute: {route_id}\nReason: {trade_result}"
-                await send_telegram_message(msg)
-                log_trade(base, mid1, mid2, profit_percent, min_liquidity, "failed", trade_result)
+            await send_telegram_message("\n".join(msg))
+            log_trade(triangle, profit_percent, trade_volume_usdt, status_msg)
+        else:
+            msg = f"❌ <b>Trade failed</b>\nRoute: {route_id}\nReason: {trade_result}"
+            await send_telegram_message(msg)
+            log_trade(triangle, profit_percent, min_liquidity, "failed", trade_result)
+
+async def check_triangle(triangle, symbols, markets):
+    try:
+        opportunity = await price_triangle(triangle, symbols, markets)
+        if opportunity:
+            await handle_opportunity(opportunity)
     except Exception as e:
+        inc_counter("errors_total", stage="triangle")
         error_msg = f"⚠️ <b>Triangle processing error</b>\n{str(e)}"
         await send_telegram_message(error_msg)
         await log_debug(f"Triangle error: {str(e)}")
 
+def create_venue_client(venue_id):
+    """Создает клиент ccxt площадки; один клиент держит свою сессию и пул соединений все время работы"""
+    prefix = venue_id.upper()
+    client = getattr(ccxt, venue_id)({
+        "enableRateLimit": False,
+        "options": {"defaultType": "spot"},
+        "apiKey": os.getenv(f"{prefix}_API_KEY"),
+        "secret": os.getenv(f"{prefix}_API_SECRET"),
+    })
+    if venue_id in VENUE_API_URLS:
+        # Все REST-адреса площадки указывают на локальную (мок) биржу
+        client.urls["api"] = {key: VENUE_API_URLS[venue_id] for key in client.urls["api"]} \
+            if isinstance(client.urls["api"], dict) else VENUE_API_URLS[venue_id]
+    return client
+
+def register_venue(venue_id, client, fee=None):
+    """Регистрирует дополнительную площадку со своими ведрами лимитов и кэшем стаканов"""
+    prefix = venue_id.upper()
+    VENUES[venue_id] = {
+        "id": venue_id,
+        "exchange": client,
+        "buckets": {
+            name: {"rate": float(os.getenv(f"{prefix}_{name.upper()}_RATE_LIMIT", bucket["rate"])), "capacity": bucket["capacity"]}
+            for name, bucket in RATE_LIMIT_BUCKETS.items()
+        },
+        "orderbook_cache": {},
+        "inflight": {},
+        "markets": {},
+        "fee": VENUE_FEES.get(venue_id, COMMISSION_RATE) if fee is None else fee
+    }
+    return VENUES[venue_id]
+
+async def load_venue_markets():
+    """Загружает спотовые рынки дополнительных площадок"""
+    for venue in VENUES.values():
+        try:
+            markets = await call_exchange("load_markets", venue=venue)
+            venue["markets"] = {s: m for s, m in markets.items() if m['active'] and m.get('spot', True)}
+            await log_debug(f"Loaded {len(venue['markets'])} active symbols on {venue['id']}")
+        except Exception as e:
+            inc_counter("errors_total", stage="venue")
+            await log_debug(f"Market load error on {venue['id']}: {str(e)}")
+
+async def get_venue_books(symbol):
+    """Стаканы пары на всех площадках, где она торгуется: venue id -> стакан"""
+    venues = [venue for venue in VENUES.values() if symbol in venue["markets"]]
+    orderbooks = await asyncio.gather(
+        get_order_book(symbol), *(get_order_book(symbol, venue) for venue in venues), return_exceptions=True
+    )
+    books = {}
+    for venue_id, orderbook in zip([PRIMARY_VENUE] + [venue["id"] for venue in venues], orderbooks):
+        if isinstance(orderbook, Exception):
+            inc_counter("errors_total", stage="orderbook")
+            await log_debug(f"Orderbook error for {symbol} on {venue_id}: {str(orderbook)}")
+        elif orderbook is not None:
+            books[venue_id] = orderbook
+    return books
+
+def venue_fee(venue_id, symbol):
+    return VENUES[venue_id]["fee"] if venue_id in VENUES else market_fee(symbol)
+
+def score_spatial(symbol, books, quote_amount):
+    """Лучшая пара площадок для покупки и продажи одной пары: (result, buy venue, sell venue, buy, sell)"""
+    best = None
+    for buy_venue, buy_book in books.items():
+        buy_price, _, _ = get_avg_price(buy_book['asks'], quote_amount)
+        if buy_price is None:
+            continue
+        for sell_venue, sell_book in books.items():
+            if sell_venue == buy_venue:
+                continue
+            sell_price, _, _ = get_avg_price(sell_book['bids'], quote_amount)
+            if sell_price is None:
+                continue
+            result = sell_price / buy_price * (1 - venue_fee(buy_venue, symbol)) * (1 - venue_fee(sell_venue, symbol))
+            if best is None or result > best[0]:
+                best = (result, buy_venue, sell_venue, buy_price, sell_price)
+    return best
+
+def score_routed_triangle(legs, venue_books, start_amount):
+    """Оценка цикла с выбором лучшей площадки на каждом шаге: (result, prices, venues, steps) или None"""
+    # Выход каждого шага монотонен по входу, поэтому жадный выбор площадки по шагам оптимален
+    amount = start_amount
+    prices, venues, steps = [], [], []
+    for symbol, side in legs:
+        best = None
+        for venue_id, orderbook in venue_books.get(symbol, {}).items():
+            price, _, _ = get_avg_price(orderbook['asks' if side == "buy" else 'bids'], amount)
+            if price is None:
+                continue
+            output = (amount / price if side == "buy" else amount * price) * (1 - venue_fee(venue_id, symbol))
+            if best is None or output > best[0]:
+                best = (output, price, venue_id)
+        if best is None:
+            return None
+        steps.append((symbol, side, amount))
+        amount, price, venue_id = best
+        prices.append(price)
+        venues.append(venue_id)
+    return amount / start_amount, prices, venues, steps
+
+async def scan_cross_venue(triangles, symbols, markets):
+    """Ищет межбиржевые возможности: одна пара на двух площадках и циклы с шагами на разных площадках"""
+    shared = {s for s in symbols if any(s in venue["markets"] for venue in VENUES.values())}
+    if not shared:
+        return []
+    
+    routed = [t for t in triangles if any(symbol in shared for symbol, _ in triangle_legs(t, symbols))]
+    leg_symbols = shared | {symbol for t in routed for symbol, _ in triangle_legs(t, symbols)}
+    leg_symbols = sorted(leg_symbols)
+    books = dict(zip(leg_symbols, await asyncio.gather(*(get_venue_books(s) for s in leg_symbols))))
+    
+    opportunities = []
+    for symbol in sorted(shared):
+        base, quote = symbol.split("/")
+        quote_amount = await get_start_amount(quote)
+        best = quote_amount and score_spatial(symbol, books[symbol], quote_amount)
+        if best:
+            result, buy_venue, sell_venue, buy_price, sell_price = best
+            opportunities.append({
+                "triangle": (quote, base),
+                "legs": [(symbol, "buy"), (symbol, "sell")],
+                "profit_percent": (result - 1) * 100,
+                "venues": [buy_venue, sell_venue],
+                "prices": [buy_price, sell_price],
+                "kind": "spatial"
+            })
+    
+    for triangle in routed:
+        legs = triangle_legs(triangle, symbols)
+        start_amount = await get_start_amount(triangle[0])
+        scored = start_amount and score_routed_triangle(legs, books, start_amount)
+        # Циклы целиком на одной площадке находит основной сканер
+        if scored and len(set(scored[2])) > 1:
+            opportunities.append({
+                "triangle": triangle,
+                "legs": legs,
+                "profit_percent": (scored[0] - 1) * 100,
+                "venues": scored[2],
+                "prices": scored[1],
+                "kind": "cross_venue"
+            })
+    
+    for venue in VENUES.values():
+        evict_orderbook_cache(venue["orderbook_cache"])
+    return [o for o in opportunities if MIN_PROFIT <= o["profit_percent"] <= MAX_PROFIT]
+
+async def run_cross_venue_scanner(triangles, symbols, markets):
+    """Фоновый межбиржевой поиск; возможности уходят в уведомления и журнал (исполнение - только на основной площадке)"""
+    symbol_set = set(symbols)
+    while True:
+        try:
+            for opportunity in await scan_cross_venue(triangles, symbol_set, markets):
+                route_id = format_route(opportunity["triangle"])
+                venue_route = ", ".join(
+                    f"{side} {symbol}@{venue}" for (symbol, side), venue in zip(opportunity["legs"], opportunity["venues"])
+                )
+                route_hash = hashlib.md5(f"{opportunity['kind']}:{venue_route}".encode()).hexdigest()
+                now = datetime.utcnow()
+                prev_time = TRIANGLE_CACHE.get(route_hash)
+                if prev_time and (now - prev_time).total_seconds() < TRIANGLE_HOLD_TIME:
+                    continue
+                TRIANGLE_CACHE[route_hash] = now
+                
+                await send_telegram_message("\n".join([
+                    f"🌐 <b>{NETWORK_NAME}: Cross-venue {opportunity['kind'].replace('_', ' ')}</b>",
+                    f"🔄 Route: {route_id}",
+                    f"🏦 Venues: {venue_route}",
+                    f"📈 <b>Spread:</b> {opportunity['profit_percent']:.2f}%"
+                ]))
+                log_trade(opportunity["triangle"], opportunity["profit_percent"], TARGET_VOLUME_USDT, "detected",
+                          f"{opportunity['kind']}: {venue_route}")
+        except Exception as e:
+            inc_counter("errors_total", stage="venue")
+            await log_debug(f"Cross-venue scan error: {str(e)}")
+        await asyncio.sleep(CROSS_VENUE_INTERVAL)
+
 async def send_balance_update():
     """Отправляет текущий баланс в Telegram"""
     try:
@@ -491,7 +2606,7 @@ async def check_exchange_connection():
     """Проверяет подключение к бирже"""
     try:
         await log_debug("Checking exchange connection...")
-        server_time = await exchange.fetch_time()
+        server_time = await call_exchange("fetch_time")
         await log_debug(f"Exchange time: {server_time}")
         return True
     except Exception as e:
@@ -500,12 +2615,476 @@ async def check_exchange_connection():
         await log_debug(f"Connection error: {str(e)}")
         return False
 
+def read_book_records(paths):
+    """Читает записанные сообщения из файлов/каталогов, сливая их по времени получения"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.jsonl*")))
+        else:
+            files.append(path)
+    
+    def read_file(path):
+        with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as f:
+            for line in f:
+                if line.strip():
+                    message = json.loads(line)
+                    yield message.get("recv_ts", (message.get("timestamp") or 0) / 1000), message
+    
+    for _, message in heapq.merge(*(read_file(path) for path in files), key=lambda item: item[0]):
+        yield message
+
+def run_backtest(paths):
+    """Прогоняет записанные стаканы через обнаружение и подбор объема с симуляцией исполнения"""
+    global MARKET_DATA_MODE
+    MARKET_DATA_MODE = "stream"  # Оценка читает только локальные стаканы
+    
+    messages = read_book_records(paths)
+    markets = {}
+    first = []
+    for message in messages:
+        if message["type"] == "markets":
+            markets.update(message["markets"])
+            continue
+        first.append(message)
+        break
+    if not markets:
+        # Запись без заголовка: восстанавливаем рынки по именам пар
+        symbols_seen = {m["symbol"] for m in first} | {m.get("symbol") for m in read_book_records(paths) if m.get("symbol")}
+        markets = {s: {"base": s.split("/")[0], "quote": s.split("/")[1], "active": True, "spot": True} for s in symbols_seen}
+    
+    symbols = list(markets)
+    triangles = asyncio.run(find_triangles(markets))
+    build_market_rules(markets)
+    routes = {t: get_route(t, markets) for t in triangles}
+    symbol_index = build_symbol_index(triangles, symbols)
+    book_symbols = sorted(set(symbol_index) | {f"{c}/USDT" for c in START_COINS if f"{c}/USDT" in markets})
+    scorer = init_batch_scorer(triangles, markets, book_symbols)
+    
+    report = {"events": 0, "opportunities": 0, "trades": 0, "filled": 0, "missed": 0, "pnl_usdt": 0.0}
+    last_detected = {}
+    pending = []  # (время исполнения, n, треугольник, объем на входе, объем в USDT)
+    first_ts = last_ts = None
+    started = time.perf_counter()
+    
+    def start_amount(base, volume_usdt):
+        if base == "USDT":
+            return volume_usdt
+        orderbook = get_local_order_book(f"{base}/USDT")
+        price = orderbook and get_avg_price(orderbook["asks"], volume_usdt)[0]
+        return volume_usdt / price if price else None
+    
+    def fill(triangle, amount, volume_usdt):
+        # Исполнение по стаканам на момент прихода ордеров на биржу
+        route = routes[triangle]
+        books = {symbol: get_local_order_book(symbol) for symbol in route["symbols"]}
+        if any(book is None for book in books.values()):
+            return None
+        if SIZING_MODE == "optimal":
+            curves = [build_fill_curve(books[symbol], side, fee) for (symbol, side), fee in zip(route["legs"], route["fees"])]
+            if any(curve is None for curve in curves):
+                return None
+            output, valid, _, _ = simulate_cycle(route, curves, [amount])
+            return (output[0] / amount - 1) * volume_usdt if valid[0] else None
+        scored = score_triangle(route["legs"], books, amount, route["fees"])
+        return None if scored is None else (scored[0] - 1) * volume_usdt
+    
+    for message in itertools.chain(first, messages):
+        if message["type"] == "markets":
+            continue
+        now = message.get("recv_ts", (message.get("timestamp") or 0) / 1000)
+        first_ts = now if first_ts is None else first_ts
+        last_ts = now
+        report["events"] += 1
+        apply_book_message(message)
+        
+        # Исполняем ордера, чья задержка истекла к этому событию
+        while pending and pending[0][0] <= now:
+            _, _, triangle, amount, volume_usdt = heapq.heappop(pending)
+            pnl = fill(triangle, amount, volume_usdt)
+            if pnl is None:
+                report["missed"] += 1
+            else:
+                report["filled"] += 1
+                report["pnl_usdt"] += pnl
+        
+        updated = set(UPDATED_SYMBOLS)
+        UPDATED_SYMBOLS.clear()
+        touched = list({t for symbol in updated for t in symbol_index.get(symbol, ())})
+        if not touched:
+            continue
+        for symbol in updated:
+            update_book_arrays(scorer, symbol, get_local_order_book(symbol))
+        
+        probe_volume = MIN_TRADE_VOLUME_USDT if SIZING_MODE == "optimal" else TARGET_VOLUME_USDT
+        start_amounts = {base: start_amount(base, probe_volume) for base in {t[0] for t in touched}}
+        for profit_percent, triangle in score_triangles_batch(scorer, touched, start_amounts):
+            report["opportunities"] += 1
+            if now - last_detected.get(triangle, float("-inf")) < TRIANGLE_HOLD_TIME:
+                continue
+            last_detected[triangle] = now
+            
+            volume_usdt = TARGET_VOLUME_USDT
+            amount = start_amount(triangle[0], volume_usdt)
+            if SIZING_MODE == "optimal":
+                route = routes[triangle]
+                books = {symbol: get_local_order_book(symbol) for symbol in route["symbols"]}
+                sizing = optimal_trade_size(route, books, volume_usdt / amount) if amount else None
+                if sizing is None:
+                    continue
+                amount, volume_usdt = sizing["size"], sizing["size_usdt"]
+            if not amount:
+                continue
+            
+            report["trades"] += 1
+            heapq.heappush(pending, (now + BACKTEST_LATENCY_MS / 1000, report["trades"], triangle, amount, volume_usdt))
+    
+    elapsed = time.perf_counter() - started
+    report.update(
+        triangles=len(triangles),
+        elapsed_s=round(elapsed, 3),
+        events_per_sec=round(report["events"] / elapsed, 1) if elapsed else None,
+        replayed_span_s=round((last_ts or 0) - (first_ts or 0), 3),
+        pnl_usdt=round(report["pnl_usdt"], 6),
+        unfilled_at_end=len(pending)
+    )
+    return report
+
+async def prepare_scan(shard=0, shard_count=1):
+    """Загружает рынки и строит треугольники, индекс символов и пакетный оценщик для своего шарда"""
+    warm = load_warm_start() if WARM_START_CACHE else None
+    if warm:
+        # Старт из кэша без сети; свежие рынки сверяются в фоне (run_market_refresh)
+        symbols, markets, triangles = warm
+    else:
+        symbols, markets = await load_symbols()
+        if not symbols:
+            return None
+        
+        triangles = await find_triangles(markets)
+        # Дескрипторы маршрутов строятся один раз: дальше оценка не обращается к рынкам
+        await load_market_rules(markets)
+        for triangle in triangles:
+            get_route(triangle, markets)
+        if WARM_START_CACHE and shard_count == 1:
+            await asyncio.to_thread(save_warm_start, markets, triangles)
+    
+    if shard_count > 1:
+        triangles = [t for t in triangles if triangle_shard(t, shard_count) == shard]
+    
+    symbol_index = build_symbol_index(triangles, symbols)
+    # Пары для пересчета объема в нестейбл стартовые валюты
+    book_symbols = sorted(set(symbol_index) | {f"{c}/USDT" for c in START_COINS if f"{c}/USDT" in markets})
+    scorer = init_batch_scorer(triangles, markets, book_symbols) if SCORING_MODE == "batch" else None
+    return symbols, markets, triangles, symbol_index, book_symbols, scorer
+
+def markets_hash(markets):
+    """Хэш активных спотовых рынков и их правил: меняется при листингах, делистингах и смене лимитов"""
+    digest = hashlib.md5()
+    for symbol in sorted(markets):
+        market = markets[symbol]
+        if market.get('active') and market.get('spot', True):
+            digest.update(json.dumps(
+                [symbol, market.get('taker'), market.get('limits'), market.get('precision')], sort_keys=True, default=str
+            ).encode())
+    return digest.hexdigest()
+
+def warm_start_key():
+    """Параметры, при смене которых кэш недействителен"""
+    return {
+        "version": WARM_START_VERSION,
+        "network": NETWORK_NAME,
+        "start_coins": START_COINS,
+        "max_cycle_length": MAX_CYCLE_LENGTH
+    }
+
+def save_warm_start(markets, triangles):
+    """Атомарно сохраняет рынки, правила рынков и маршруты всех треугольников"""
+    payload = dict(
+        warm_start_key(),
+        saved_at=time.time(),
+        markets_hash=markets_hash(markets),
+        markets={symbol: {k: v for k, v in market.items() if k != "info"} for symbol, market in markets.items()},
+        rules={symbol: rules for symbol, rules in MARKET_RULES.items() if symbol in markets},
+        triangles=[list(t) for t in triangles],
+        routes=[ROUTES[t] for t in triangles if t in ROUTES]
+    )
+    directory = os.path.dirname(WARM_START_CACHE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = WARM_START_CACHE + ".tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        json.dump(payload, f, separators=(",", ":"), default=str)
+    os.replace(tmp_path, WARM_START_CACHE)
+    WARM_START["hash"] = payload["markets_hash"]
+
+def load_warm_start():
+    """Читает кэш быстрого старта; None, если его нет, он устарел или не совпадает по версии/хэшу"""
+    started = time.perf_counter()
+    try:
+        with gzip.open(WARM_START_CACHE, "rt") as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Warm start cache unreadable: {str(e)}")
+        return None
+    
+    age = time.time() - payload.get("saved_at", 0)
+    if any(payload.get(k) != v for k, v in warm_start_key().items()) or age > WARM_START_MAX_AGE:
+        return None
+    markets = payload["markets"]
+    if markets_hash(markets) != payload["markets_hash"]:
+        return None
+    
+    if hasattr(exchange, "set_markets"):
+        exchange.set_markets(list(markets.values()))
+    MARKET_RULES.clear()
+    MARKET_RULES.update(payload["rules"])
+    ROUTES.clear()
+    triangles = [tuple(t) for t in payload["triangles"]]
+    for triangle, route in zip(triangles, payload["routes"]):
+        route["legs"] = [tuple(leg) for leg in route["legs"]]
+        ROUTES[triangle] = route
+    
+    symbols = [symbol for symbol, market in markets.items() if market['active'] and market.get('spot', True)]
+    WARM_START.update(loaded=True, hash=payload["markets_hash"])
+    print(
+        f"Warm start: {len(symbols)} symbols, {len(triangles)} triangles from cache "
+        f"(age {age:.0f}s, loaded in {(time.perf_counter() - started) * 1000:.0f} ms)"
+    )
+    return symbols, markets, triangles
+
+async def reconcile_warm_start(prepared, shard=0, shard_count=1):
+    """Сверяет состояние, поднятое из кэша, со свежими рынками и комиссиями аккаунта"""
+    symbols, markets, triangles, symbol_index, book_symbols, scorer = prepared
+    added, removed = await refresh_markets(prepared, shard, shard_count)
+    
+    await load_market_rules(markets)
+    # load_market_rules сбросил маршруты: перестраиваем их и строки оценщика без await между шагами
+    for triangle in triangles:
+        get_route(triangle, markets)
+    if scorer is not None:
+        add_scorer_triangles(scorer, triangles, markets)
+    
+    if shard_count == 1:
+        await asyncio.to_thread(save_warm_start, markets, triangles)
+    WARM_START["loaded"] = False
+    return added, removed
+
+async def refresh_markets(prepared, shard=0, shard_count=1):
+    """Сверяет рынки с биржей и точечно добавляет/удаляет треугольники и подписки на стаканы"""
+    symbols, markets, triangles, symbol_index, book_symbols, scorer = prepared
+    fresh = dict(await call_exchange("load_markets", True))
+    active = {symbol for symbol, market in fresh.items() if market['active'] and market.get('spot', True)}
+    current = set(symbols)
+    added, removed = active - current, current - active
+    if not added and not removed:
+        # Листинги те же: обновляем только метаданные рынков (лимиты, статусы)
+        markets.update(fresh)
+        return [], []
+    
+    discovered = await find_triangles(fresh)
+    if shard_count > 1:
+        discovered = [t for t in discovered if triangle_shard(t, shard_count) == shard]
+    
+    # Дальше состояние меняется без await: цикл оценки видит его либо целиком старым, либо новым
+    markets.clear()
+    markets.update(fresh)
+    symbols[:] = [symbol for symbol in symbols if symbol in active] + sorted(added)
+    for symbol in added:
+        MARKET_RULES[symbol] = market_rule(fresh[symbol])
+    
+    dropped_triangles = {t for symbol in removed for t in symbol_index.get(symbol, ())}
+    existing = set(triangles) - dropped_triangles
+    new_triangles = [t for t in discovered if t not in existing and get_route(t, markets)]
+    
+    for triangle in dropped_triangles:
+        route = ROUTES.pop(triangle, None)
+        for symbol in (route["symbols"] if route else []):
+            if symbol in symbol_index:
+                symbol_index[symbol] = [t for t in symbol_index[symbol] if t != triangle]
+                if not symbol_index[symbol]:
+                    del symbol_index[symbol]
+        if scorer is not None:
+            scorer["triangle_rows"].pop(triangle, None)
+    for symbol in removed:
+        symbol_index.pop(symbol, None)
+    
+    triangles[:] = [t for t in triangles if t not in dropped_triangles] + new_triangles
+    for triangle in new_triangles:
+        for symbol in ROUTES[triangle]["symbols"]:
+            symbol_index.setdefault(symbol, []).append(triangle)
+    
+    wanted = set(symbol_index) | {f"{c}/USDT" for c in START_COINS if f"{c}/USDT" in active}
+    dropped_books = set(book_symbols) - wanted
+    book_symbols[:] = sorted(wanted)
+    if scorer is not None:
+        add_scorer_rows(scorer, book_symbols)
+        add_scorer_triangles(scorer, new_triangles, markets)
+    for symbol in dropped_books:
+        if scorer is not None and symbol in scorer["rows"]:
+            scorer["loaded"][scorer["rows"][symbol]] = False
+        LOCAL_BOOKS.pop(symbol, None)
+        ORDERBOOK_CACHE.pop(symbol, None)
+        BOOK_FINGERPRINTS.pop(symbol, None)
+        UPDATED_SYMBOLS.discard(symbol)
+    SUBSCRIPTIONS_CHANGED.set()
+    
+    return new_triangles, list(dropped_triangles)
+
+async def run_market_refresh(prepared, shard=0, shard_count=1):
+    """Фоновая сверка рынков: листинги и делистинги подхватываются без перезапуска"""
+    while True:
+        # После старта из кэша первая сверка идет сразу
+        if not WARM_START["loaded"]:
+            if not MARKET_REFRESH_INTERVAL:
+                return
+            await asyncio.sleep(MARKET_REFRESH_INTERVAL)
+        try:
+            if WARM_START["loaded"]:
+                added, removed = await reconcile_warm_start(prepared, shard, shard_count)
+            else:
+                added, removed = await refresh_markets(prepared, shard, shard_count)
+                if (added or removed) and WARM_START_CACHE and shard_count == 1:
+                    await asyncio.to_thread(save_warm_start, prepared[1], prepared[2])
+            if (added or removed) and RECORD_BOOKS_DIR:
+                # Без нового заголовка бэктест не увидит новые пары и их треугольники
+                record_markets(prepared[1], prepared[4])
+            if added or removed:
+                await log_debug(
+                    f"Markets refreshed: +{len(added)} / -{len(removed)} triangles, "
+                    f"{len(prepared[2])} total, {len(prepared[4])} books"
+                )
+        except Exception as e:
+            WARM_START["loaded"] = False
+            inc_counter("errors_total", stage="markets")
+            await log_debug(f"Market refresh error: {str(e)}")
+
+def triangle_shard(triangle, shard_count):
+    """Стабильный номер шарда треугольника, одинаковый во всех процессах"""
+    return int(hashlib.md5(format_route(triangle).encode()).hexdigest(), 16) % shard_count
+
+def scale_rate_limits(share, kinds=("public", "account")):
+    """Оставляет процессу долю общих на аккаунт лимитов API"""
+    for kind in kinds:
+        bucket = RATE_LIMIT_BUCKETS[kind]
+        bucket["rate"] *= share
+        bucket["capacity"] = max(bucket["capacity"] * share, max(w for _, w in ENDPOINT_WEIGHTS.values()))
+
+async def push_worker_metrics(shard, metrics):
+    """Периодически отправляет исполнителю снимок метрик сканера для /metrics и сводки"""
+    while True:
+        await asyncio.sleep(SHARD_METRICS_INTERVAL)
+        try:
+            metrics.put_nowait((shard, metrics_snapshot()))
+        except queue.Full:
+            pass
+
+async def consume_worker_metrics(metrics):
+    """Исполнитель: хранит последние снимки метрик процессов-сканеров"""
+    while True:
+        try:
+            shard, snapshot = await asyncio.to_thread(metrics.get, True, 1)
+        except queue.Empty:
+            continue
+        WORKER_METRICS[shard] = snapshot
+
+async def scan_worker_loop(shard, shard_count, opportunities, metrics=None):
+    """Сканирует свой шард треугольников и публикует найденные возможности исполнителю"""
+    global TELEGRAM_ENABLED
+    TELEGRAM_ENABLED = False  # Уведомления, журнал и сделки - только в процессе-исполнителе
+    ensure_exchange()
+    
+    # Лимиты API общие на аккаунт: исполнитель оставляет себе EXECUTOR_RATE_SHARE, остальное делят сканеры.
+    # Ордера отправляет только исполнитель, его ведро сканерам не нужно
+    scale_rate_limits((1 - EXECUTOR_RATE_SHARE) / shard_count)
+    metrics_task = asyncio.create_task(push_worker_metrics(shard, metrics)) if metrics is not None else None
+    
+    async def publish(triangle, symbols, markets):
+        opportunity = await price_triangle(triangle, symbols, markets)
+        if opportunity:
+            try:
+                opportunities.put_nowait(opportunity)
+            except queue.Full:
+                inc_counter("opportunities_dropped_total")
+    
+    try:
+        prepared = await prepare_scan(shard, shard_count)
+        if prepared is None:
+            return
+        symbols, markets, triangles, symbol_index, book_symbols, scorer = prepared
+        print(f"Scan worker {shard}/{shard_count}: {len(triangles)} triangles, {len(book_symbols)} books")
+        refresh_task = asyncio.create_task(run_market_refresh(prepared, shard, shard_count)) \
+            if MARKET_REFRESH_INTERVAL or WARM_START["loaded"] else None
+        
+        stream_task = None
+        while True:
+            start_time = time.time()
+            if MARKET_DATA_MODE == "stream":
+                if stream_task is None or stream_task.done():
+                    stream_task = asyncio.create_task(run_market_data_stream(book_symbols))
+                try:
+                    await asyncio.wait_for(BOOK_UPDATE_EVENT.wait(), timeout=SCAN_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                evict_orderbook_cache()
+                if SCAN_SCHEDULER == "adaptive":
+                    await refresh_order_books(schedule_book_fetches(triangles, markets, book_symbols))
+                else:
+                    await refresh_order_books(book_symbols)
+            
+            _, triangle_count = await evaluate_updated_triangles(symbol_index, symbols, markets, scorer, check=publish)
+            report_first_scan(triangle_count, f"Scan worker {shard}/{shard_count}")
+            if MARKET_DATA_MODE != "stream":
+                await asyncio.sleep(max(1, SCAN_INTERVAL - (time.time() - start_time)))
+    finally:
+        if metrics_task:
+            metrics_task.cancel()
+        await exchange.close()
+
+def run_scan_worker(shard, shard_count, opportunities, metrics=None):
+    """Точка входа процесса-сканера"""
+    try:
+        asyncio.run(scan_worker_loop(shard, shard_count, opportunities, metrics))
+    except KeyboardInterrupt:
+        pass
+
+def start_scan_worker(shard, shard_count, opportunities, metrics=None):
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_scan_worker, args=(shard, shard_count, opportunities, metrics), name=f"scan-worker-{shard}", daemon=True
+    )
+    process.start()
+    return process
+
+async def consume_opportunities(opportunities):
+    """Исполнитель: единственный владелец TRADE_COUNTER и TRIANGLE_CACHE для всех шардов"""
+    tasks = set()
+    while True:
+        try:
+            opportunity = await asyncio.to_thread(opportunities.get, True, 1)
+        except queue.Empty:
+            continue
+        task = asyncio.create_task(handle_opportunity(opportunity))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(report_opportunity_error)
+
+def report_opportunity_error(task):
+    if not task.cancelled() and task.exception():
+        inc_counter("errors_total", stage="triangle")
+        print(f"Opportunity handling error: {str(task.exception())}")
+
 async def main_loop():
     """Основной цикл работы бота"""
     await log_debug("Bot starting...")
+    # Telegram поднимается в фоне сразу: алерты об ошибках запуска тоже должны уйти
+    launch_telegram()
     
     # Инициализация счетчиков
     init_counters()
+    ensure_exchange()
     
     # Проверка подключения к бирже
     connected = await check_exchange_connection()
@@ -514,59 +3093,182 @@ async def main_loop():
         
     await send_telegram_message(f"🤖 <b>Bot started ({NETWORK_NAME})</b>")
     
-    symbols, markets = await load_symbols()
-    if not symbols:
+    started = time.perf_counter()
+    prepared = await prepare_scan()
+    STARTUP["phases"]["markets"] = time.perf_counter() - started
+    if prepared is None:
         await send_telegram_message("⚠️ <b>No trading symbols found!</b>")
         return
-        
-    triangles = await find_triangles(symbols)
+    
+    symbols, markets, triangles, symbol_index, book_symbols, scorer = prepared
     if not triangles:
         await send_telegram_message("⚠️ <b>No arbitrage triangles found!</b>")
     
-    if telegram_app:
-        await telegram_app.initialize()
-        await telegram_app.start()
+    for venue_id in EXTRA_VENUES:
+        register_venue(venue_id, create_venue_client(venue_id))
+    await load_venue_markets()
+
+    stream_task = None
+    opportunities = None
+    worker_metrics = None
+    if SHARD_WORKERS > 1:
+        # Сканирование идет в процессах-шардах, этот процесс только исполняет
+        context = multiprocessing.get_context("spawn")
+        opportunities = context.Queue(OPPORTUNITY_QUEUE_SIZE)
+        worker_metrics = context.Queue(SHARD_WORKERS * 4)
+        scale_rate_limits(EXECUTOR_RATE_SHARE)
+        SCAN_WORKERS[:] = [start_scan_worker(i, SHARD_WORKERS, opportunities, worker_metrics) for i in range(SHARD_WORKERS)]
+        scorer = None
+    elif MARKET_DATA_MODE == "stream":
+        stream_task = asyncio.create_task(run_market_data_stream(book_symbols))
+    
+    # Остатки и тикеры поддерживаются в фоне, торговый путь читает только локальное состояние
+    background_tasks = []
+    if METRICS_PORT:
+        background_tasks.append(asyncio.create_task(run_metrics_server()))
+    if opportunities is not None:
+        background_tasks.append(asyncio.create_task(consume_opportunities(opportunities)))
+        background_tasks.append(asyncio.create_task(consume_worker_metrics(worker_metrics)))
+    if VENUES:
+        background_tasks.append(asyncio.create_task(run_cross_venue_scanner(triangles, symbols, markets)))
+    if MARKET_REFRESH_INTERVAL or WARM_START["loaded"]:
+        background_tasks.append(asyncio.create_task(run_market_refresh(prepared)))
+    if RECORD_BOOKS_DIR:
+        record_markets(markets, book_symbols)
+        background_tasks.append(asyncio.create_task(run_book_recorder()))
+    if not TESTNET_MODE:
+        background_tasks.append(asyncio.create_task(refresh_tickers_loop()))
+        await seed_account_balances()
+        background_tasks.append(asyncio.create_task(reconcile_balances_loop()))
+        if ACCOUNT_STREAM:
+            background_tasks.append(asyncio.create_task(run_balance_stream()))
 
     last_balance_update = time.time()
     last_counter_reset = time.time()
+    last_report = time.time()
+    last_metrics_summary = time.time()
+    evaluated_symbols = 0
+    evaluated_triangles = 0
     
     while True:
         try:
-            await log_debug("Starting scan cycle...")
             start_time = time.time()
             
             # Сбрасываем счетчики при необходимости
             now = time.time()
+            evict_orderbook_cache()
             if now - last_counter_reset > 60:
                 await check_rate_limits()
                 last_counter_reset = now
             
-            # Проверяем все треугольники
-            for triangle in triangles:
+            if SCAN_WORKERS:
+                await asyncio.sleep(SCAN_INTERVAL)
+                for i, process in enumerate(SCAN_WORKERS):
+                    if not process.is_alive():
+                        await log_debug(f"Scan worker {i} exited ({process.exitcode}), restarting...")
+                        SCAN_WORKERS[i] = start_scan_worker(i, SHARD_WORKERS, opportunities, worker_metrics)
+            elif MARKET_DATA_MODE == "stream":
+                # Ждем обновлений стаканов вместо фиксированной паузы
                 try:
-                    await check_triangle(*triangle, symbols, markets)
-                except Exception as e:
-                    await log_debug(f"Triangle error: {str(e)}")
-                await asyncio.sleep(0.5)  # Задержка между треугольниками
+                    await asyncio.wait_for(BOOK_UPDATE_EVENT.wait(), timeout=SCAN_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await log_debug("Starting scan cycle...")
+                fetch_started = time.time()
+                if SCAN_SCHEDULER == "adaptive":
+                    await refresh_order_books(schedule_book_fetches(triangles, markets, book_symbols))
+                else:
+                    await refresh_order_books(book_symbols)
+                fetch_time = time.time() - fetch_started
+            
+            # Проверяем только треугольники с изменившимися стаканами
+            if not SCAN_WORKERS:
+                updated_count, triangle_count = await evaluate_updated_triangles(symbol_index, symbols, markets, scorer)
+                first_scan = report_first_scan(triangle_count)
+                if first_scan:
+                    await send_telegram_message(f"⏱ {first_scan}")
+                evaluated_symbols += updated_count
+                evaluated_triangles += triangle_count
                 
             # Отправляем баланс каждый час
             if now - last_balance_update > 3600:
                 await send_balance_update()
                 last_balance_update = now
                 
+            if now - last_metrics_summary >= METRICS_SUMMARY_INTERVAL:
+                # Сводка печатается всегда, как и время до первого скана: без DEBUG_MODE log_debug молчит
+                print(f"[METRICS {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}] {summarize_metrics()}")
+                last_metrics_summary = now
+            
+            if stream_task and stream_task.done() and not MARKET_DATA_REPLAY_FILE:
+                error = None if stream_task.cancelled() else stream_task.exception()
+                await log_debug(f"Market data stream stopped ({error}), restarting...")
+                stream_task = asyncio.create_task(run_market_data_stream(book_symbols))
+            
             cycle_time = time.time() - start_time
-            await log_debug(f"Scan cycle completed in {cycle_time:.2f}s")
+            if SCAN_WORKERS:
+                continue
+            if MARKET_DATA_MODE == "stream":
+                # В потоковом режиме цикл идет на каждое обновление, отчет - раз в SCAN_INTERVAL
+                if time.time() - last_report >= SCAN_INTERVAL:
+                    await log_debug(
+                        f"Re-evaluated {evaluated_triangles} triangles for "
+                        f"{evaluated_symbols} book updates in the last {time.time() - last_report:.0f}s"
+                    )
+                    last_report = time.time()
+                    evaluated_symbols = evaluated_triangles = 0
+                continue
+            
+            cache_stats = reset_orderbook_cache_stats()
+            request_stats = reset_rate_limit_stats()
+            await log_debug(
+                f"Scan cycle completed in {cycle_time:.2f}s: {evaluated_triangles} triangles "
+                f"for {evaluated_symbols} changed books "
+                f"(orderbook cache: {cache_stats['hits']} hits / {cache_stats['misses']} REST fetches, "
+                f"{cache_stats['evictions']} evicted; "
+                f"{cache_stats['misses'] / max(fetch_time, 0.001):.1f} books/s, "
+                f"{request_stats['requests']} requests, {request_stats['throttled']} throttled, "
+                f"{request_stats['rejections']} rate-limit rejections; schedule: {describe_schedule()})"
+            )
+            evaluated_symbols = evaluated_triangles = 0
             await asyncio.sleep(max(1, SCAN_INTERVAL - cycle_time))
             
         except Exception as e:
+            inc_counter("errors_total", stage="main_loop")
             await log_debug(f"Main loop error: {str(e)}")
             await asyncio.sleep(30)
 
+async def wait_for_telegram():
+    """Ждет, пока start_telegram поднимет бота или завершится с ошибкой"""
+    while telegram_app is None and not telegram_task.done():
+        await asyncio.sleep(0.1)
+
 async def shutdown():
     """Корректное завершение работы"""
     try:
-        await exchange.close()
+        for process in SCAN_WORKERS:
+            process.terminate()
+        await flush_journal()
+        if RECORD_BUFFER:
+            await asyncio.to_thread(write_book_records, RECORD_BUFFER[:])
+            RECORD_BUFFER.clear()
+        if exchange is not None:
+            await exchange.close()
+        for venue in VENUES.values():
+            await venue["exchange"].close()
+        if telegram_app is None and not ALERT_QUEUE.empty() and launch_telegram():
+            # Ошибка до начала цикла: бот мог еще не подняться, а алерты о ней уже в очереди
+            try:
+                await asyncio.wait_for(wait_for_telegram(), timeout=10)
+            except asyncio.TimeoutError:
+                print("Telegram did not start before shutdown")
         if telegram_app:
+            try:
+                await asyncio.wait_for(drain_notifications(), timeout=10)
+            except asyncio.TimeoutError:
+                print("Pending Telegram notifications dropped on shutdown")
+            telegram_task.cancel()
             await telegram_app.stop()
             await telegram_app.shutdown()
     except Exception as e:
@@ -574,6 +3276,7 @@ async def shutdown():
 
 async def main():
     """Точка входа в приложение"""
+    journal_task = asyncio.create_task(run_journal_writer())
     try:
         await main_loop()
     except KeyboardInterrupt:
@@ -583,7 +3286,15 @@ async def main():
         await send_telegram_message(error_msg)
         await log_debug(f"Critical error: {str(e)}")
     finally:
+        journal_task.cancel()
         await shutdown()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "export-journal":
+        # python Deepseek.py export-journal trades.csv [journal_dir]
+        export_journal_csv(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == "backtest":
+        # python Deepseek.py backtest books/ [more files...]
+        print(json.dumps(run_backtest(sys.argv[2:]), indent=2))
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,272 @@
+# benchmark.py - замеры горячих путей бота без сети
+# python benchmark.py [results.json] [--baseline old.json]
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+os.environ.setdefault("DEBUG_MODE", "false")
+os.environ.setdefault("WARM_START_CACHE", "")
+import Deepseek as bot
+
+UNIVERSES = [int(n) for n in os.getenv("BENCH_UNIVERSES", "200,1000,3000").split(",")]  # Число пар в синтетическом рынке
+BOOK_DEPTHS = [int(n) for n in os.getenv("BENCH_BOOK_DEPTHS", "20,50,200").split(",")]  # Уровней в стакане
+SCORING_SAMPLES = int(os.getenv("BENCH_SCORING_SAMPLES", "2000"))  # Треугольников для замера задержки оценки
+SEED = 42
+
+def cross_pairs(coins, quotes):
+    """Число различных пар между монетами, где хотя бы одна из quotes первых монет котируемая"""
+    return quotes * (coins - 1) - quotes * (quotes - 1) // 2
+
+class SyntheticExchange:
+    """Биржа в памяти: рынки и стаканы генерируются из seed, сетевых запросов нет"""
+    id = "synthetic"
+    precisionMode = bot.ccxt.TICK_SIZE
+    apiKey = None
+    has = {}
+
+    def __init__(self, n_symbols, depth, seed=SEED):
+        rnd = random.Random(seed)
+        coins = [f"C{i}" for i in range(max(3, n_symbols // 4))]
+        self.prices = {coin: rnd.uniform(0.01, 1000) for coin in coins}
+        self.prices["USDT"] = 1.0
+        self.depth = depth
+        self.rnd = rnd
+        self.markets = {}
+
+        for coin in coins[:n_symbols // 2]:
+            self.add_market(coin, "USDT")
+        # Котируемых монет столько, чтобы различных пар между монетами хватило на n_symbols
+        quotes = coins[:max(2, len(coins) // 10)]
+        while len(self.markets) + cross_pairs(len(coins), len(quotes)) < n_symbols:
+            if len(quotes) == len(coins):
+                raise ValueError(f"Synthetic market cannot hold {n_symbols} symbols")
+            quotes = coins[:len(quotes) + 1]
+        while len(self.markets) < n_symbols:
+            base, quote = rnd.choice(coins), rnd.choice(quotes)
+            if base != quote and f"{quote}/{base}" not in self.markets:
+                self.add_market(base, quote)
+
+    def add_market(self, base, quote):
+        self.markets[f"{base}/{quote}"] = {
+            "id": f"{base}{quote}", "symbol": f"{base}/{quote}", "base": base, "quote": quote,
+            "active": True, "spot": True, "type": "spot", "taker": 0.001,
+            "limits": {"amount": {"min": 1e-6}, "cost": {"min": 1}},
+            "precision": {"amount": 1e-6, "price": 1e-8}
+        }
+
+    def make_book(self, symbol, depth=None):
+        depth = depth or self.depth
+        base, quote = symbol.split("/")
+        mid = self.prices[base] / self.prices[quote] * (1 + self.rnd.uniform(-0.002, 0.002))
+        return {
+            "symbol": symbol,
+            "bids": [[mid * (1 - 0.0002 * (i + 1)), self.rnd.uniform(0.1, 10)] for i in range(depth)],
+            "asks": [[mid * (1 + 0.0002 * (i + 1)), self.rnd.uniform(0.1, 10)] for i in range(depth)],
+            "timestamp": int(time.time() * 1000),
+            "nonce": None
+        }
+
+    async def load_markets(self, reload=False):
+        return self.markets
+
+    async def fetch_order_book(self, symbol, limit=None):
+        return self.make_book(symbol, limit)
+
+    def market(self, symbol):
+        return self.markets[symbol]
+
+    async def close(self):
+        pass
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {"p50_us": pick(0.5) * 1e6, "p95_us": pick(0.95) * 1e6, "p99_us": pick(0.99) * 1e6, "max_us": samples[-1] * 1e6}
+
+def measure(fn):
+    """Выполняет fn, возвращая (результат, секунды, пик памяти Python в МБ)"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2 ** 20
+
+def timed(fn):
+    """Время выполнения fn в секундах без tracemalloc"""
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+def bench_import():
+    """Запуск интерпретатора и импорт модуля бота в чистом процессе, сек"""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import Deepseek"], check=True,
+                   cwd=os.path.dirname(os.path.abspath(bot.__file__)))
+    return time.perf_counter() - started
+
+def bench_discovery(n_symbols):
+    """find_triangles и построение маршрутов на синтетическом рынке"""
+    exchange = SyntheticExchange(n_symbols, 20)
+    triangles, elapsed, peak = measure(lambda: asyncio.run(bot.find_triangles(exchange.markets)))
+    bot.build_market_rules(exchange.markets)
+    _, routes_elapsed, _ = measure(lambda: [bot.get_route(t, exchange.markets) for t in triangles])
+    return {
+        "symbols": len(exchange.markets),
+        "triangles": len(triangles),
+        "discovery_s": elapsed,
+        "triangles_per_sec": len(triangles) / elapsed if elapsed else None,
+        "routes_s": routes_elapsed,
+        "peak_mb": peak
+    }
+
+def bench_pricing(depth):
+    """get_avg_price по обеим сторонам синтетических стаканов: списки ccxt и OrderBook"""
+    exchange = SyntheticExchange(500, depth)
+    books = [exchange.make_book(symbol) for symbol in exchange.markets]
+    array_books = [bot.OrderBook.from_ccxt(book) for book in books]
+
+    def price_all(books):
+        for book in books:
+            mid = book["asks"][0][0]
+            # Цель - примерно треть глубины стакана в котируемой валюте
+            target = mid * depth * 1.5
+            bot.get_avg_price(book["asks"], target)
+            bot.get_avg_price(book["bids"], target)
+
+    # Память - на отдельной копии: tracemalloc сильно замедляет выделение и исказил бы скорость
+    _, _, peak = measure(lambda: price_all(books))
+    fresh_books = [bot.OrderBook.from_ccxt(book) for book in books]
+    _, _, array_peak = measure(lambda: price_all(fresh_books))
+    elapsed = timed(lambda: price_all(books))
+    # Первый проход после загрузки - линейный, второй строит накопленные суммы,
+    # дальше только бинарный поиск: замеряется каждое состояние отдельно
+    array_elapsed = timed(lambda: price_all(array_books))
+    cumsum_elapsed = timed(lambda: price_all(array_books))
+    cached_elapsed = timed(lambda: price_all(array_books))
+    return {
+        "depth": depth,
+        "books": len(books),
+        "books_per_sec": len(books) / elapsed,
+        "peak_mb": peak,
+        "orderbook_books_per_sec": len(books) / array_elapsed,
+        "orderbook_cumsum_books_per_sec": len(books) / cumsum_elapsed,
+        "orderbook_cached_books_per_sec": len(books) / cached_elapsed,
+        "orderbook_peak_mb": array_peak
+    }
+
+async def bench_scoring(n_symbols, depth):
+    """Оценка треугольников: полный путь price_triangle по локальным стаканам, скалярно и пакетно"""
+    exchange = SyntheticExchange(n_symbols, depth)
+    bot.exchange = exchange
+    bot.MARKET_DATA_MODE = "stream"
+    bot.STREAM_DEPTH_LIMIT = depth
+    bot.LOCAL_BOOKS.clear()
+
+    symbols, markets, triangles, symbol_index, book_symbols, scorer = await bot.prepare_scan()
+    for symbol in book_symbols:
+        bot.apply_book_message(bot.orderbook_to_message(symbol, exchange.make_book(symbol)))
+    bot.UPDATED_SYMBOLS.clear()
+
+    sample = random.Random(SEED).sample(triangles, min(SCORING_SAMPLES, len(triangles)))
+    latencies = []
+    for triangle in sample:
+        started = time.perf_counter()
+        await bot.price_triangle(triangle, symbols, markets)
+        latencies.append(time.perf_counter() - started)
+
+    start_amounts = {base: await bot.get_start_amount(base) for base in {t[0] for t in triangles}}
+    for symbol in book_symbols:
+        bot.update_book_arrays(scorer, symbol, bot.get_local_order_book(symbol))
+    tracemalloc.start()
+    started = time.perf_counter()
+    bot.score_triangles_batch(scorer, triangles, start_amounts)
+    batch_elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "symbols": n_symbols,
+        "depth": depth,
+        "triangles": len(triangles),
+        "scalar": dict(percentiles(latencies), samples=len(latencies)),
+        "batch_s": batch_elapsed,
+        "batch_triangles_per_sec": len(triangles) / batch_elapsed if batch_elapsed else None,
+        "batch_peak_mb": peak / 2 ** 20
+    }
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def compare(results, baseline):
+    """Печатает изменение ключевых метрик относительно прошлого прогона"""
+    def index(run):
+        metrics = {"import_s": run.get("import_s")}
+        for row in run["discovery"]:
+            metrics[f"discovery[{row['symbols']}].triangles_per_sec"] = row["triangles_per_sec"]
+        for row in run["pricing"]:
+            metrics[f"pricing[{row['depth']}].books_per_sec"] = row["books_per_sec"]
+            metrics[f"pricing[{row['depth']}].orderbook_books_per_sec"] = row.get("orderbook_books_per_sec")
+            metrics[f"pricing[{row['depth']}].orderbook_cached_books_per_sec"] = row.get("orderbook_cached_books_per_sec")
+        for row in run["scoring"]:
+            metrics[f"scoring[{row['symbols']}x{row['depth']}].p95_us"] = row["scalar"].get("p95_us")
+            metrics[f"scoring[{row['symbols']}x{row['depth']}].batch_triangles_per_sec"] = row["batch_triangles_per_sec"]
+        return metrics
+
+    old = index(baseline)
+    for key, value in index(results).items():
+        if old.get(key) and value:
+            print(f"{key}: {old[key]:.1f} -> {value:.1f} ({(value / old[key] - 1) * 100:+.1f}%)")
+
+def main(argv):
+    baseline = None
+    if "--baseline" in argv:
+        position = argv.index("--baseline")
+        with open(argv[position + 1]) as f:
+            baseline = json.load(f)
+        argv = argv[:position] + argv[position + 2:]
+    output = argv[0] if argv else os.path.join("bench", f"results-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json")
+
+    # Лимиты запросов не участвуют в замере: биржа в памяти
+    for bucket in bot.RATE_LIMIT_BUCKETS.values():
+        bucket["rate"] = bucket["capacity"] = 1e9
+
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "import_s": bench_import(),
+        "discovery": [bench_discovery(n) for n in UNIVERSES],
+        "pricing": [bench_pricing(depth) for depth in BOOK_DEPTHS],
+        "scoring": [asyncio.run(bench_scoring(n, depth)) for n in UNIVERSES for depth in BOOK_DEPTHS[:1]]
+                   + [asyncio.run(bench_scoring(UNIVERSES[0], depth)) for depth in BOOK_DEPTHS[1:]],
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Saved to {output}")
+    if baseline:
+        compare(results, baseline)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,208 @@
+# test_deepseek.py - проверки горячих путей бота на бирже в памяти, без сети
+# python -m pytest -q
+import asyncio
+import itertools
+import os
+import random
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("DEBUG_MODE", "false")
+os.environ.setdefault("WARM_START_CACHE", "")
+os.environ.setdefault("RECORD_BOOKS_DIR", "")
+import Deepseek as bot
+from benchmark import SyntheticExchange
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    """Каждый тест начинает с пустого глобального состояния бота"""
+    for name in ("ROUTES", "MARKET_RULES", "LOCAL_BOOKS", "ORDERBOOK_CACHE", "ORDERBOOK_INFLIGHT",
+                 "BOOK_FINGERPRINTS", "RESYNC_TASKS", "COUNTERS", "HISTOGRAMS", "STREAM_HEARTBEAT"):
+        monkeypatch.setattr(bot, name, type(getattr(bot, name))())
+    monkeypatch.setattr(bot, "UPDATED_SYMBOLS", set())
+    # Лимиты запросов не участвуют: биржа в памяти
+    monkeypatch.setattr(bot, "RATE_LIMIT_BUCKETS", {name: {"rate": 1e9, "capacity": 1e9} for name in bot.RATE_LIMIT_BUCKETS})
+
+def use_exchange(monkeypatch, exchange, mode="stream"):
+    monkeypatch.setattr(bot, "exchange", exchange)
+    monkeypatch.setattr(bot, "MARKET_DATA_MODE", mode)
+
+def load_stream_books(exchange, symbols, rnd, thin_share=0.0):
+    """Снапшоты всех символов в локальные стаканы; часть стаканов - в один уровень"""
+    for symbol in symbols:
+        depth = 1 if rnd.random() < thin_share else None
+        bot.apply_book_message(bot.orderbook_to_message(symbol, exchange.make_book(symbol, depth)))
+    return {symbol: bot.get_local_order_book(symbol) for symbol in symbols}
+
+def test_batch_scoring_matches_scalar(monkeypatch):
+    exchange = SyntheticExchange(300, 20, seed=7)
+    use_exchange(monkeypatch, exchange)
+    monkeypatch.setattr(bot, "MIN_PROFIT", -100.0)
+    monkeypatch.setattr(bot, "MAX_PROFIT", 100.0)
+    symbols, markets, triangles, _, book_symbols, scorer = asyncio.run(bot.prepare_scan())
+    assert triangles
+
+    books = load_stream_books(exchange, book_symbols, random.Random(1), thin_share=0.2)
+    for symbol, orderbook in books.items():
+        bot.update_book_arrays(scorer, symbol, orderbook)
+    start_amounts = {base: asyncio.run(bot.get_start_amount(base)) for base in {t[0] for t in triangles}}
+
+    profits = {}
+    bot.score_triangles_batch(scorer, triangles, start_amounts, profits)
+    unfillable = 0
+    for triangle in triangles:
+        route = bot.get_route(triangle, markets)
+        scored = bot.score_triangle(route["legs"], books, start_amounts[triangle[0]], route["fees"])
+        if scored is None:
+            unfillable += 1
+            assert not np.isfinite(profits[triangle]), triangle
+        else:
+            assert profits[triangle] == pytest.approx((scored[0] - 1) * 100, abs=1e-9), triangle
+    # Оба случая действительно проверены
+    assert 0 < unfillable < len(triangles)
+
+@pytest.mark.parametrize("descending", [True, False])
+def test_book_side_matches_reference(descending):
+    """BookSide.load/update против словаря уровней с обрезкой по глубине, цена исполнения - против списков"""
+    rnd = random.Random(1)
+    for _ in range(200):
+        capacity = rnd.choice([3, 5, 20])
+        side = bot.BookSide(capacity, descending)
+        reference = {}
+
+        def expected():
+            return sorted(reference.items(), reverse=descending)[:capacity]
+
+        levels = [[rnd.randint(1, 30) / 10, rnd.choice([0, 1, 2.5])] for _ in range(rnd.randint(0, 10))]
+        if rnd.random() < 0.5:
+            levels.sort(reverse=descending)  # Отсортированный снапшот идет быстрым путем load
+        side.load(levels)
+        for price, size in levels:
+            reference[price] = size
+        reference = dict(sorted({p: s for p, s in reference.items() if s}.items(), reverse=descending)[:capacity])
+        assert [tuple(level) for level in side.tolist()] == expected()
+
+        for _ in range(40):
+            price, size = rnd.randint(1, 30) / 10, rnd.choice([0, 0, 1, 3])
+            side.update(price, size)
+            if size:
+                reference[price] = size
+            else:
+                reference.pop(price, None)
+            reference = dict(expected())
+            assert [tuple(level) for level in side.tolist()] == expected()
+
+            plain = side.tolist()
+            target = rnd.uniform(0, 20)
+            # Два прохода: линейный по свежему стакану и бинарный поиск по накопленным суммам
+            for _ in range(2):
+                walked, priced = bot.get_avg_price(plain, target), side.fill_price(target)
+                assert (walked[0] is None) == (priced[0] is None), (plain, target)
+                assert walked[1] == pytest.approx(priced[1], abs=1e-9)
+                if walked[0] is not None:
+                    assert walked[0] == pytest.approx(priced[0], abs=1e-9)
+
+@pytest.mark.parametrize("max_length", [3, 4])
+def test_find_triangles_matches_brute_force(monkeypatch, max_length):
+    exchange = SyntheticExchange(60, 5, seed=3)
+    exchange.markets["C1/USDT"] = dict(exchange.markets["C1/USDT"], active=False)  # Неактивные пары не участвуют
+    monkeypatch.setattr(bot, "MAX_CYCLE_LENGTH", max_length)
+    monkeypatch.setattr(bot, "START_COINS", ["USDT", "C0"])
+
+    pairs = {frozenset((m["base"], m["quote"])) for m in exchange.markets.values() if m["active"]}
+    currencies = sorted({c for pair in pairs for c in pair})
+    expected = set()
+    for base in bot.START_COINS:
+        for length in range(3, max_length + 1):
+            for path in itertools.permutations([c for c in currencies if c != base], length - 1):
+                cycle = (base,) + path
+                if all(frozenset((a, b)) in pairs for a, b in zip(cycle, cycle[1:] + cycle[:1])):
+                    expected.add(cycle)
+
+    found = asyncio.run(bot.find_triangles(exchange.markets))
+    assert len(found) == len(set(found))
+    assert set(found) == expected
+    assert any(len(cycle) == max_length for cycle in found)
+
+def test_refresh_markets_matches_full_rebuild(monkeypatch):
+    exchange = SyntheticExchange(300, 10, seed=7)
+    use_exchange(monkeypatch, exchange)
+    monkeypatch.setattr(bot, "MIN_PROFIT", -100.0)
+    monkeypatch.setattr(bot, "MAX_PROFIT", 100.0)
+    prepared = asyncio.run(bot.prepare_scan())
+    symbols, markets, triangles, symbol_index, book_symbols, scorer = prepared
+
+    # Делистинг части пар и листинг новой монеты с парами к USDT и C0
+    rnd = random.Random(2)
+    for symbol in rnd.sample(sorted(exchange.markets), 20):
+        exchange.markets[symbol] = dict(exchange.markets[symbol], active=False)
+    exchange.prices["NEW"] = 5.0
+    exchange.add_market("NEW", "USDT")
+    exchange.add_market("NEW", "C0")
+    added, removed = asyncio.run(bot.refresh_markets(prepared))
+    assert added and removed
+    assert any("NEW" in triangle for triangle in added)
+
+    incremental_routes = {t: bot.ROUTES[t] for t in triangles}
+    monkeypatch.setattr(bot, "ROUTES", {})
+    monkeypatch.setattr(bot, "MARKET_RULES", {})
+    _, _, full_triangles, full_index, full_book_symbols, full_scorer = asyncio.run(bot.prepare_scan())
+
+    assert len(triangles) == len(set(triangles))
+    assert set(triangles) == set(full_triangles)
+    assert {s: sorted(t) for s, t in symbol_index.items()} == {s: sorted(t) for s, t in full_index.items()}
+    assert sorted(book_symbols) == sorted(full_book_symbols)
+    assert incremental_routes == {t: bot.ROUTES[t] for t in full_triangles}
+
+    # Дополненный пакетный оценщик считает так же, как построенный заново
+    books = load_stream_books(exchange, full_book_symbols, rnd)
+    for symbol, orderbook in books.items():
+        bot.update_book_arrays(scorer, symbol, orderbook)
+        bot.update_book_arrays(full_scorer, symbol, orderbook)
+    start_amounts = {base: asyncio.run(bot.get_start_amount(base)) for base in {t[0] for t in full_triangles}}
+    incremental, full = {}, {}
+    bot.score_triangles_batch(scorer, triangles, start_amounts, incremental)
+    bot.score_triangles_batch(full_scorer, full_triangles, start_amounts, full)
+    assert incremental.keys() == full.keys()
+    for triangle, profit in full.items():
+        assert incremental[triangle] == pytest.approx(profit, abs=1e-9, nan_ok=True)
+
+class ReplayExchange:
+    """REST-снапшот для ресинхронизации: состояние стакана после потерянных дельт 3 и 4"""
+    async def fetch_order_book(self, symbol, limit=None):
+        await asyncio.sleep(0.01)  # Дельты 6 и 7 приходят, пока снапшот загружается
+        return {"symbol": symbol, "bids": [[10.0, 3.0], [9.0, 1.0]], "asks": [[11.0, 1.0], [12.0, 2.0]],
+                "timestamp": 4, "nonce": 4}
+
+def book_message(kind, seq, bids, asks):
+    return {"symbol": "AAA/USDT", "type": kind, "seq": seq, "timestamp": seq, "bids": bids, "asks": asks}
+
+def test_stream_replay_recovers_from_gap(monkeypatch):
+    use_exchange(monkeypatch, ReplayExchange())
+    messages = [
+        book_message("snapshot", 1, [[10.0, 1.0], [9.0, 1.0]], [[11.0, 1.0], [12.0, 1.0]]),
+        book_message("delta", 2, [[10.0, 2.0]], []),
+        book_message("delta", 2, [[10.0, 7.0]], []),  # Дубликат игнорируется
+        book_message("delta", 5, [], [[11.0, 0.0]]),  # Дельты 3 и 4 потеряны
+        book_message("delta", 6, [[9.5, 1.0]], []),
+        book_message("delta", 7, [], [[13.0, 1.0]]),
+    ]
+
+    async def feed():
+        for message in messages:
+            yield message
+            await asyncio.sleep(0)
+
+    async def replay():
+        await bot.run_market_data_stream(["AAA/USDT"], feed=feed())
+        await asyncio.gather(*bot.RESYNC_TASKS.values())
+
+    asyncio.run(replay())
+    book = bot.get_local_order_book("AAA/USDT")
+    assert book is not None and book.nonce == 7
+    assert book["bids"].tolist() == [[10.0, 3.0], [9.5, 1.0], [9.0, 1.0]]
+    assert book["asks"].tolist() == [[12.0, 2.0], [13.0, 1.0]]
+    events = {dict(labels)["kind"]: value for (name, labels), value in bot.COUNTERS.items() if name == "stream_events_total"}
+    assert events == {"snapshot": 2, "delta": 4, "gap": 1, "resync": 1}  # 2, затем 5-7 после снапшота
+    assert not bot.RESYNC_TASKS